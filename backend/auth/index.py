@@ -1,171 +1,387 @@
+import functools
 import json
 import os
 import psycopg2
-import bcrypt
+import psycopg2.extensions
+import psycopg2.pool
+import base64
+import hashlib
+import hmac
+import re
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+TRACE_ENABLED = os.environ.get('TRACE_REQUESTS') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAINABLE = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+# Замеры текущего вызова; None — трассировка выключена и все хуки сводятся к одной проверке
+_trace = None
+
+@contextmanager
+def traced(phase: str):
+    '''Добавляет время блока к фазе запроса (connect, query, serialize, s3, bcrypt)'''
+    if _trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, started)
+
+def add_phase(phase: str, started: float) -> None:
+    if _trace is not None:
+        _trace['phases'][phase] = _trace['phases'].get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+class TracedCursor(psycopg2.extensions.cursor):
+    '''Курсор соединений пула: при включённой трассировке считает запросы и строки,
+    медленные запросы пишет в лог вместе с планом'''
+    def execute(self, query, vars=None):
+        if _trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        add_phase('query', started)
+        _trace['queries'] += 1
+        _trace['rows'] += max(self.rowcount, 0)
+        if elapsed >= SLOW_QUERY_MS:
+            _trace['slow'].append({
+                'sql': prepared_text(self.connection, query),
+                'ms': round(elapsed, 1),
+                'plan': explain_statement(self.connection, query, vars)
+            })
+        return result
+
+def prepared_text(conn, query):
+    '''Для EXECUTE stmt_N — исходный текст подготовленного запроса, параметры в лог не попадают'''
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        name = query.split()[1]
+        for sql, (prepared_name, _) in conn.prepared.items():
+            if prepared_name == name:
+                return sql
+    return query
+
+def explain_statement(conn, query: str, vars):
+    '''План медленного запроса без повторного выполнения; в транзакции — под savepoint, чтобы ошибка EXPLAIN её не сломала'''
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(EXPLAINABLE) or ';' in query.rstrip().rstrip(';'):
+        return None
+    savepoint = not conn.autocommit and conn.status != psycopg2.extensions.STATUS_READY
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT trace_explain')
+            cursor.execute('EXPLAIN ' + query, vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT trace_explain')
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return str(e)
+
+def instrumented(function_name: str):
+    '''Обёртка handler: при TRACE_REQUESTS=1 отдаёт фазы в заголовке Server-Timing
+    и пишет одну структурированную строку лога на вызов'''
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            global _trace
+            _trace = {'phases': {}, 'queries': 0, 'rows': 0, 'slow': []}
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                trace, _trace = _trace, None
+            total = (time.perf_counter() - started) * 1000
+            
+            timing = [f'{phase};dur={ms:.1f}' for phase, ms in trace['phases'].items()]
+            timing.append(f'total;dur={total:.1f}')
+            timing.append(f"db;desc=\"{trace['queries']} queries, {trace['rows']} rows\"")
+            response['headers'] = {**response.get('headers', {}), 'Server-Timing': ', '.join(timing), 'Timing-Allow-Origin': '*'}
+            print(json.dumps({
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'status': response['statusCode'],
+                'total_ms': round(total, 1),
+                'phases': {phase: round(ms, 1) for phase, ms in trace['phases'].items()},
+                'queries': trace['queries'],
+                'rows': trace['rows'],
+                'slow_queries': trace['slow'],
+                'error': json.loads(response['body']).get('error') if response['statusCode'] >= 500 else None
+            }, ensure_ascii=False, default=str))
+            return response
+        return wrapper
+    return decorate
+
+def json_response(status: int, payload, headers: dict = None) -> dict:
+    '''Ответ API в JSON с CORS-заголовками'''
+    with traced('serialize'):
+        body = json.dumps(payload)
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **(headers or {})},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def cors_preflight(methods: str, allow_headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS-запрос браузера'''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def request_body(event: dict) -> dict:
+    '''JSON-тело запроса; пустое тело — пустой словарь'''
+    return json.loads(event.get('body') or '{}')
+
+def query_params(event: dict) -> dict:
+    '''Параметры строки запроса; шлюз передаёт None, если их нет'''
+    return event.get('queryStringParameters') or {}
+
+SESSION_TTL_SECONDS = 12 * 3600
+SESSION_HEADER = 'X-Session-Token'
+
+def b64url(raw: bytes) -> str:
+    '''base64url без выравнивающих "="'''
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def session_signature(payload: str) -> str:
+    '''HMAC-SHA256 от полезной нагрузки токена на общем секрете функций'''
+    secret = os.environ['SESSION_SECRET'].encode('utf-8')
+    return b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+def issue_session(role: str, subject_id: int, expires_at: datetime = None) -> dict:
+    '''Подписанный токен сессии. Остальные функции проверяют его без БД и bcrypt,
+    поэтому пароль сверяется один раз на сессию. Сессия стола не переживает срок стола'''
+    expires = int(time.time()) + SESSION_TTL_SECONDS
+    if expires_at is not None:
+        expires = min(expires, int(expires_at.timestamp()))
+    claims = {'role': role, 'id': subject_id, 'expires_at': expires}
+    payload = b64url(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    return {
+        'token': f'{payload}.{session_signature(payload)}',
+        'expires_at': datetime.fromtimestamp(expires).isoformat()
+    }
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_PING_AFTER_SECONDS = 30
+# Потолок подготовленных операторов на соединение: каждый занимает память бэкенда Postgres
+PREPARED_CACHE_SIZE = 64
+
+# Пул соединений инстанса: переживает тёплые вызовы, одно соединение держится открытым
+_db_pool = None
+_db_last_used = {}
+
+SQL_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула с кэшем подготовленных операторов: кэш живёт ровно столько, сколько сессия Postgres'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_total = 0
+        self.cursor_factory = TracedCursor
+
+def execute_prepared(cursor, sql: str, params=()):
+    '''Выполняет запрос через PREPARE/EXECUTE. Разбор и план строятся один раз на соединение,
+    тёплые вызовы функции с тем же соединением из пула только подставляют параметры.
+    Плейсхолдеры как у psycopg2: %s или %(name)s'''
+    conn = cursor.connection
+    statements = conn.prepared
+    if sql in statements:
+        # Порядок словаря — порядок использования: вытесняется самый давно не нужный оператор
+        statements[sql] = statements.pop(sql)
+    else:
+        if len(statements) >= PREPARED_CACHE_SIZE:
+            evicted, _ = statements.pop(next(iter(statements)))
+            cursor.execute(f'DEALLOCATE {evicted}')
+        keys = []
+        
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) else len(keys)
+            if key not in keys:
+                keys.append(key)
+            return f'${keys.index(key) + 1}'
+        
+        # Имя из счётчика соединения, а не из размера кэша: после вытеснения размер повторяется
+        name = f'stmt_{conn.prepared_total}'
+        conn.prepared_total += 1
+        cursor.execute(f'PREPARE {name} AS {SQL_PLACEHOLDER.sub(number, sql)}')
+        statements[sql] = (name, keys)
+    
+    name, keys = statements[sql]
+    values = [params[key] for key in keys]
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}', values)
+
+def get_connection():
+    '''Соединение из пула; простоявшее дольше DB_PING_AFTER_SECONDS проверяется перед выдачей'''
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, DB_POOL_SIZE, os.environ['DATABASE_URL'], connection_factory=PreparedConnection
+        )
+    
+    with traced('connect'):
+        conn = _db_pool.getconn()
+        last_used = _db_last_used.pop(id(conn), None)
+        if conn.closed or (last_used and time.monotonic() - last_used > DB_PING_AFTER_SECONDS and not ping_connection(conn)):
+            _db_pool.putconn(conn, close=True)
+            conn = _db_pool.getconn()
+    return conn
+
+def ping_connection(conn) -> bool:
+    '''Живо ли соединение после простоя'''
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул в чистом состоянии; сломанное закрывается'''
+    try:
+        if not conn.closed:
+            conn.rollback()
+            if conn.autocommit:
+                with conn.cursor() as cursor:
+                    cursor.execute('UNLISTEN *')
+                conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+    _db_last_used[id(conn)] = time.monotonic()
+    _db_pool.putconn(conn, close=bool(conn.closed))
+
+def hash_password(password: str) -> str:
+    '''bcrypt-хэш пароля; bcrypt загружается при первом обращении, а не при холодном старте'''
+    import bcrypt
+    with traced('bcrypt'):
+        return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def check_password(password: str, password_hash: str) -> bool:
+    '''Сверка пароля с bcrypt-хэшем'''
+    import bcrypt
+    with traced('bcrypt'):
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
+@instrumented('auth')
 def handler(event: dict, context) -> dict:
     '''API для авторизации администраторов и столов караоке-системы'''
     
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return cors_preflight('POST, OPTIONS')
     
     if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
-        }
+        return json_response(405, {'error': 'Method not allowed'})
     
+    conn = None
     try:
-        body = json.loads(event.get('body', '{}'))
+        body = request_body(event)
         action = body.get('action')
         username = body.get('username')
         password = body.get('password')
         
         if not username or not password:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Username and password required'}),
-                'isBase64Encoded': False
-            }
+            return json_response(400, {'error': 'Username and password required'})
         
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cursor = conn.cursor()
         
         if action == 'admin_login':
-            cursor.execute(
-                f"SELECT id, username, password_hash, role FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE username = '{username}'"
+            execute_prepared(
+                cursor,
+                f"SELECT id, username, password_hash, role FROM {os.environ['MAIN_DB_SCHEMA']}.users WHERE username = %s",
+                (username,)
             )
             user = cursor.fetchone()
             
             if not user:
-                conn.close()
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(401, {'error': 'Invalid credentials'})
             
             if user[2] == 'temp_hash':
-                hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-                cursor.execute(
-                    f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.users SET password_hash = '{hashed}' WHERE id = {user[0]}"
+                hashed = hash_password(password)
+                execute_prepared(
+                    cursor,
+                    f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.users SET password_hash = %s WHERE id = %s",
+                    (hashed, user[0])
                 )
                 conn.commit()
                 
-                conn.close()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'user': {'id': user[0], 'username': user[1], 'role': user[3]}
-                    }),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {
+                    'success': True,
+                    'user': {'id': user[0], 'username': user[1], 'role': user[3]},
+                    'session': issue_session('admin', user[0])
+                })
             
-            if bcrypt.checkpw(password.encode('utf-8'), user[2].encode('utf-8')):
-                conn.close()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'user': {'id': user[0], 'username': user[1], 'role': user[3]}
-                    }),
-                    'isBase64Encoded': False
-                }
+            if check_password(password, user[2]):
+                return json_response(200, {
+                    'success': True,
+                    'user': {'id': user[0], 'username': user[1], 'role': user[3]},
+                    'session': issue_session('admin', user[0])
+                })
             else:
-                conn.close()
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(401, {'error': 'Invalid credentials'})
         
         elif action == 'table_login':
-            cursor.execute(
-                f"SELECT id, table_number, login, password_hash, expires_at, is_active FROM {os.environ['MAIN_DB_SCHEMA']}.tables WHERE login = '{username}' AND is_active = true"
+            execute_prepared(
+                cursor,
+                f"SELECT id, table_number, login, password_hash, expires_at, is_active FROM {os.environ['MAIN_DB_SCHEMA']}.tables WHERE login = %s AND is_active = true",
+                (username,)
             )
             table = cursor.fetchone()
             
             if not table:
-                conn.close()
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(401, {'error': 'Invalid credentials'})
             
             expires_at = table[4]
             if datetime.now() > expires_at:
-                cursor.execute(
-                    f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET is_active = false WHERE id = {table[0]}"
+                execute_prepared(
+                    cursor,
+                    f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET is_active = false WHERE id = %s",
+                    (table[0],)
                 )
                 conn.commit()
-                conn.close()
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Session expired'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(401, {'error': 'Session expired'})
             
-            if bcrypt.checkpw(password.encode('utf-8'), table[3].encode('utf-8')):
-                conn.close()
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'table': {
-                            'id': table[0],
-                            'table_number': table[1],
-                            'login': table[2],
-                            'expires_at': table[4].isoformat()
-                        }
-                    }),
-                    'isBase64Encoded': False
-                }
+            if check_password(password, table[3]):
+                return json_response(200, {
+                    'success': True,
+                    'table': {
+                        'id': table[0],
+                        'table_number': table[1],
+                        'login': table[2],
+                        'expires_at': table[4].isoformat()
+                    },
+                    'session': issue_session('table', table[0], table[4])
+                })
             else:
-                conn.close()
-                return {
-                    'statusCode': 401,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Invalid credentials'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(401, {'error': 'Invalid credentials'})
         
         else:
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid action'}),
-                'isBase64Encoded': False
-            }
+            return json_response(400, {'error': 'Invalid action'})
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
+    
+    finally:
+        if conn is not None:
+            release_connection(conn)
@@ -1,198 +1,959 @@
+import functools
 import json
 import os
 import psycopg2
-from datetime import datetime
+import psycopg2.extensions
+import psycopg2.pool
+import base64
+import gzip
+import hashlib
+import hmac
+import re
+import select
+import time
+from contextlib import contextmanager
+from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_WAIT_SECONDS = 25
+FEED_PAGE_SIZE = 500
+MAX_TABLE_WEIGHT = 4
+DEFAULT_SONG_SECONDS = 240
+MAX_BULK_ITEMS = 500
+# Ограничения добавления для планшетов столов: ведро токенов и потолок ожидающих треков
+ENQUEUE_RATE_PER_MINUTE = float(os.environ.get('QUEUE_RATE_PER_MINUTE', '4'))
+ENQUEUE_BURST = int(os.environ.get('QUEUE_BURST', '5'))
+MAX_PENDING_PER_TABLE = int(os.environ.get('QUEUE_MAX_PENDING_PER_TABLE', '10'))
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_IDEMPOTENCY_KEY_LENGTH = 64
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+TRACE_ENABLED = os.environ.get('TRACE_REQUESTS') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAINABLE = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+# Замеры текущего вызова; None — трассировка выключена и все хуки сводятся к одной проверке
+_trace = None
+
+@contextmanager
+def traced(phase: str):
+    '''Добавляет время блока к фазе запроса (connect, query, serialize, s3)'''
+    if _trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, started)
+
+def add_phase(phase: str, started: float) -> None:
+    if _trace is not None:
+        _trace['phases'][phase] = _trace['phases'].get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+class TracedCursor(psycopg2.extensions.cursor):
+    '''Курсор соединений пула: при включённой трассировке считает запросы и строки,
+    медленные запросы пишет в лог вместе с планом'''
+    def execute(self, query, vars=None):
+        if _trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        add_phase('query', started)
+        _trace['queries'] += 1
+        _trace['rows'] += max(self.rowcount, 0)
+        if elapsed >= SLOW_QUERY_MS:
+            _trace['slow'].append({
+                'sql': prepared_text(self.connection, query),
+                'ms': round(elapsed, 1),
+                'plan': explain_statement(self.connection, query, vars)
+            })
+        return result
+
+def prepared_text(conn, query):
+    '''Для EXECUTE stmt_N — исходный текст подготовленного запроса, параметры в лог не попадают'''
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        name = query.split()[1]
+        for sql, (prepared_name, _) in conn.prepared.items():
+            if prepared_name == name:
+                return sql
+    return query
+
+def explain_statement(conn, query: str, vars):
+    '''План медленного запроса без повторного выполнения; в транзакции — под savepoint, чтобы ошибка EXPLAIN её не сломала'''
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(EXPLAINABLE) or ';' in query.rstrip().rstrip(';'):
+        return None
+    savepoint = not conn.autocommit and conn.status != psycopg2.extensions.STATUS_READY
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT trace_explain')
+            cursor.execute('EXPLAIN ' + query, vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT trace_explain')
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return str(e)
+
+def instrumented(function_name: str):
+    '''Обёртка handler: при TRACE_REQUESTS=1 отдаёт фазы в заголовке Server-Timing
+    и пишет одну структурированную строку лога на вызов'''
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            global _trace
+            _trace = {'phases': {}, 'queries': 0, 'rows': 0, 'slow': []}
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                trace, _trace = _trace, None
+            total = (time.perf_counter() - started) * 1000
+            
+            timing = [f'{phase};dur={ms:.1f}' for phase, ms in trace['phases'].items()]
+            timing.append(f'total;dur={total:.1f}')
+            timing.append(f"db;desc=\"{trace['queries']} queries, {trace['rows']} rows\"")
+            response['headers'] = {**response.get('headers', {}), 'Server-Timing': ', '.join(timing), 'Timing-Allow-Origin': '*'}
+            print(json.dumps({
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'status': response['statusCode'],
+                'total_ms': round(total, 1),
+                'phases': {phase: round(ms, 1) for phase, ms in trace['phases'].items()},
+                'queries': trace['queries'],
+                'rows': trace['rows'],
+                'slow_queries': trace['slow'],
+                'error': json.loads(response['body']).get('error') if response['statusCode'] >= 500 and not response['isBase64Encoded'] else None
+            }, ensure_ascii=False, default=str))
+            return response
+        return wrapper
+    return decorate
+
+def json_default(value):
+    '''Типы из БД, которых нет в JSON: даты в ISO 8601, numeric в число'''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def encode_json(payload) -> bytes:
+    '''JSON в UTF-8 одним вызовом кодировщика: orjson, если установлен, иначе стандартный json'''
+    with traced('serialize'):
+        if orjson is not None:
+            return orjson.dumps(payload, default=json_default)
+        return json.dumps(payload, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def response_encoding(event, body: bytes):
+    '''Сжатие под Accept-Encoding клиента: br, если доступен brotli, иначе gzip; маленькие тела не сжимаются'''
+    if not event or len(body) < COMPRESS_MIN_BYTES:
+        return None
+    header = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'accept-encoding'), '')
+    accepted = set()
+    for part in header.split(','):
+        name, _, weight = part.strip().partition(';')
+        if weight.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    if 'br' in accepted and brotli is not None:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def encoded_body(body: bytes, encoding) -> str:
+    '''Тело ответа шлюзу: UTF-8 как есть или сжатое и в base64'''
+    if encoding is None:
+        return body.decode('utf-8')
+    with traced('compress'):
+        packed = brotli.compress(body, quality=BROTLI_QUALITY) if encoding == 'br' else gzip.compress(body, GZIP_LEVEL, mtime=0)
+    return base64.b64encode(packed).decode('ascii')
+
+def json_response(status: int, payload, headers: dict = None, event: dict = None) -> dict:
+    '''Ответ API в JSON с CORS-заголовками. С event большое тело сжимается под Accept-Encoding клиента'''
+    body = encode_json(payload)
+    encoding = response_encoding(event, body)
+    compression = {'Content-Encoding': encoding} if encoding else {}
+    negotiated = {'Vary': 'Accept-Encoding'} if event else {}
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **negotiated, **compression, **(headers or {})},
+        'body': encoded_body(body, encoding),
+        'isBase64Encoded': encoding is not None
+    }
+
+def cors_preflight(methods: str, allow_headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS-запрос браузера'''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def request_body(event: dict) -> dict:
+    '''JSON-тело запроса; пустое тело — пустой словарь'''
+    return json.loads(event.get('body') or '{}')
+
+def query_params(event: dict) -> dict:
+    '''Параметры строки запроса; шлюз передаёт None, если их нет'''
+    return event.get('queryStringParameters') or {}
+
+SESSION_HEADER = 'X-Session-Token'
+
+def b64url(raw: bytes) -> str:
+    '''base64url без выравнивающих "="'''
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def session_signature(payload: str) -> str:
+    '''HMAC-SHA256 от полезной нагрузки токена на общем секрете функций'''
+    secret = os.environ['SESSION_SECRET'].encode('utf-8')
+    return b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+def read_session(event: dict):
+    '''Claims из заголовка X-Session-Token; None, если токена нет, он не разбирается, подпись не сошлась или срок истёк'''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    payload, _, signature = (headers.get(SESSION_HEADER.lower()) or '').partition('.')
+    # Не-ASCII в токене ломает кодирование и compare_digest: такой токен просто не принимается
+    try:
+        if not payload or not hmac.compare_digest(signature.encode('ascii'), session_signature(payload).encode('ascii')):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('expires_at', 0) <= time.time():
+        return None
+    return claims
+
+def session_denied(session, *roles):
+    '''Ответ 401/403, если сессии нет или её роль не подходит; None — доступ разрешён'''
+    if session is None:
+        return json_response(401, {'error': 'Session token required'})
+    if session['role'] not in roles:
+        return json_response(403, {'error': 'Forbidden'})
+    return None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_PING_AFTER_SECONDS = 30
+# Потолок подготовленных операторов на соединение: каждый занимает память бэкенда Postgres
+PREPARED_CACHE_SIZE = 64
+
+# Пул соединений инстанса: переживает тёплые вызовы, одно соединение держится открытым
+_db_pool = None
+_db_last_used = {}
+
+SQL_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула с кэшем подготовленных операторов: кэш живёт ровно столько, сколько сессия Postgres'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_total = 0
+        self.cursor_factory = TracedCursor
+
+def execute_prepared(cursor, sql: str, params=()):
+    '''Выполняет запрос через PREPARE/EXECUTE. Разбор и план строятся один раз на соединение,
+    тёплые вызовы функции с тем же соединением из пула только подставляют параметры.
+    Плейсхолдеры как у psycopg2: %s или %(name)s'''
+    conn = cursor.connection
+    statements = conn.prepared
+    if sql in statements:
+        # Порядок словаря — порядок использования: вытесняется самый давно не нужный оператор
+        statements[sql] = statements.pop(sql)
+    else:
+        if len(statements) >= PREPARED_CACHE_SIZE:
+            evicted, _ = statements.pop(next(iter(statements)))
+            cursor.execute(f'DEALLOCATE {evicted}')
+        keys = []
+        
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) else len(keys)
+            if key not in keys:
+                keys.append(key)
+            return f'${keys.index(key) + 1}'
+        
+        # Имя из счётчика соединения, а не из размера кэша: после вытеснения размер повторяется
+        name = f'stmt_{conn.prepared_total}'
+        conn.prepared_total += 1
+        cursor.execute(f'PREPARE {name} AS {SQL_PLACEHOLDER.sub(number, sql)}')
+        statements[sql] = (name, keys)
+    
+    name, keys = statements[sql]
+    values = [params[key] for key in keys]
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}', values)
+
+def get_connection():
+    '''Соединение из пула; простоявшее дольше DB_PING_AFTER_SECONDS проверяется перед выдачей'''
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, DB_POOL_SIZE, os.environ['DATABASE_URL'], connection_factory=PreparedConnection
+        )
+    
+    with traced('connect'):
+        conn = _db_pool.getconn()
+        last_used = _db_last_used.pop(id(conn), None)
+        if conn.closed or (last_used and time.monotonic() - last_used > DB_PING_AFTER_SECONDS and not ping_connection(conn)):
+            _db_pool.putconn(conn, close=True)
+            conn = _db_pool.getconn()
+    return conn
+
+def ping_connection(conn) -> bool:
+    '''Живо ли соединение после простоя'''
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул в чистом состоянии; сломанное закрывается'''
+    try:
+        if not conn.closed:
+            conn.rollback()
+            if conn.autocommit:
+                with conn.cursor() as cursor:
+                    cursor.execute('UNLISTEN *')
+                conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+    _db_last_used[id(conn)] = time.monotonic()
+    _db_pool.putconn(conn, close=bool(conn.closed))
+
+def queue_scheduler() -> str:
+    '''Режим очереди из QUEUE_SCHEDULER: fifo (по времени добавления), round_robin или weighted'''
+    mode = os.environ.get('QUEUE_SCHEDULER', 'fifo')
+    return mode if mode in ('fifo', 'round_robin', 'weighted') else 'fifo'
+
+def queue_order(alias: str = 'q') -> str:
+    '''ORDER BY для порядка воспроизведения в текущем режиме'''
+    prefix = f'{alias}.' if alias else ''
+    # play_order уникален и растёт при добавлении: без перестановок это порядок заказа
+    if queue_scheduler() == 'fifo':
+        return f'{prefix}play_order'
+    return f'{prefix}sched_round, {prefix}play_order'
+
+def table_weight_sql() -> str:
+    '''Вес стола в раунде: в режиме weighted — оплаченные часы (от 1 до MAX_TABLE_WEIGHT)'''
+    if queue_scheduler() != 'weighted':
+        return '1.0'
+    return f'LEAST({MAX_TABLE_WEIGHT}, GREATEST(1.0, EXTRACT(EPOCH FROM (expires_at - created_at)) / 3600))'
+
+def current_round_sql() -> str:
+    '''Текущий раунд очереди: раунд играющего трека, иначе первого ожидающего'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    return f"""COALESCE(
+        (SELECT sched_round FROM {schema}.queue WHERE status = 'playing' ORDER BY played_at DESC LIMIT 1),
+        (SELECT MIN(sched_round) FROM {schema}.queue WHERE status = 'pending'),
+        0
+    )"""
+
+def queue_item(item) -> dict:
+    '''Строка выборки очереди с треком и номером стола'''
+    return {
+        'id': item[0],
+        'song_id': item[1],
+        'table_id': item[2],
+        'status': item[3],
+        'added_at': item[4],
+        'played_at': item[5],
+        'song': {
+            'title': item[6],
+            'artist': item[7],
+            'genre': item[8],
+            'file_url': item[9],
+            'file_format': item[10]
+        },
+        'table_number': item[11]
+    }
+
+def queue_changes(cursor, since: int, table_id) -> tuple:
+    '''Строки очереди с ревизией больше since (в любом статусе) страницами по FEED_PAGE_SIZE.
+    Возвращает (строки, ревизия для следующего запроса, есть ли ещё изменения)'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    # Ревизию читаем до выборки: строки, изменённые между запросами, придут повторно, но не потеряются
+    execute_prepared(cursor, f"SELECT COALESCE(MAX(revision), 0) FROM {schema}.queue")
+    revision = cursor.fetchone()[0]
+    
+    query = f"""
+        SELECT q.id, q.song_id, q.table_id, q.status, q.added_at, q.played_at,
+               s.title, s.artist, s.genre, s.file_url, s.file_format,
+               t.table_number, q.revision
+        FROM {schema}.queue q
+        JOIN {schema}.songs s ON q.song_id = s.id
+        JOIN {schema}.tables t ON q.table_id = t.id
+        WHERE q.revision > %s
+    """
+    sql_params = [since]
+    if table_id:
+        query += " AND q.table_id = %s"
+        sql_params.append(table_id)
+    execute_prepared(cursor, query + " ORDER BY q.revision LIMIT %s", sql_params + [FEED_PAGE_SIZE + 1])
+    items = cursor.fetchall()
+    
+    has_more = len(items) > FEED_PAGE_SIZE
+    items = items[:FEED_PAGE_SIZE]
+    # Неполная страница — клиент догнал ревизию, прочитанную до выборки
+    revision = items[-1][12] if has_more else max([revision, since] + [item[12] for item in items])
+    return [queue_item(item) for item in items], revision, has_more
+
+def advance_queue(cursor, current_id, next_id=None, replace_current: bool = False) -> tuple:
+    '''Завершает текущий трек и ставит следующий одной транзакцией.
+    current_id — трек, который оператор видит играющим (None — оператор видит, что ничего не играет);
+    если играет другой, очередь уже сдвинули. replace_current снимает эту проверку для прежнего API.
+    next_id — трек, выбранный оператором вне порядка очереди; если его уже нельзя взять, ничего не меняется.
+    Возвращает (успех, id завершённых, строка нового трека или None).'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    # Advisory-lock отдельным оператором: следующий оператор получает свежий снимок после коммита предыдущего
+    cursor.execute(
+        f"""
+        SELECT pg_advisory_xact_lock(hashtext('{schema}.queue_advance'));
+        WITH current AS (
+            SELECT id FROM {schema}.queue WHERE status = 'playing' FOR UPDATE
+        ), allowed AS (
+            SELECT (%(replace_current)s OR NOT EXISTS (SELECT 1 FROM current WHERE id IS DISTINCT FROM %(current_id)s))
+                   AND (%(next_id)s::int IS NULL OR EXISTS (
+                       SELECT 1 FROM {schema}.queue WHERE id = %(next_id)s AND status = 'pending'
+                   )) AS ok
+        ), finished AS (
+            UPDATE {schema}.queue q SET status = 'played'
+            FROM current, allowed
+            WHERE q.id = current.id AND allowed.ok
+            RETURNING q.id
+        ), next AS (
+            SELECT id FROM {schema}.queue
+            WHERE status = 'pending' AND (SELECT ok FROM allowed)
+              AND (%(next_id)s::int IS NULL OR id = %(next_id)s)
+            ORDER BY {queue_order('')}
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        ), claimed AS (
+            UPDATE {schema}.queue q SET status = 'playing', played_at = CURRENT_TIMESTAMP
+            FROM next
+            WHERE q.id = next.id
+            RETURNING q.*
+        )
+        SELECT a.ok, ARRAY(SELECT id FROM finished),
+               c.id, c.song_id, c.table_id, c.status, c.added_at, c.played_at,
+               s.title, s.artist, s.genre, s.file_url, s.file_format,
+               t.table_number
+        FROM allowed a
+        LEFT JOIN claimed c ON true
+        LEFT JOIN {schema}.songs s ON s.id = c.song_id
+        LEFT JOIN {schema}.tables t ON t.id = c.table_id
+        """,
+        {'current_id': current_id, 'next_id': next_id, 'replace_current': replace_current}
+    )
+    row = cursor.fetchone()
+    playing = row[2:] if row[2] is not None else None
+    # Выбранный трек мог пропустить SKIP LOCKED (его держит свипер или снятие): текущий тогда не завершаем
+    if next_id is not None and playing is None:
+        return False, [], None
+    return row[0], row[1], playing
+
+def enqueue_song(cursor, song_id, table_id, idempotency_key, limited: bool):
+    '''Добавляет трек стола одним обращением к БД. Повтор с тем же ключом идемпотентности отдаёт
+    уже добавленный трек; при limited списывается токен из ведра стола и проверяется потолок ожидающих.
+    Возвращает (исход, секунд до следующего токена, строка трека) или None, если стола нет или он выключен'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    # Блокировка строки стола отдельным оператором: запросы одного стола идут друг за другом,
+    # и второй оператор видит ведро, счётчик и ключи после коммита предыдущего запроса
+    cursor.execute(
+        f"""
+        SELECT 1 FROM {schema}.tables WHERE id = %(table_id)s FOR UPDATE;
+        WITH existing AS (
+            SELECT id, song_id, table_id, status, added_at FROM {schema}.queue
+            WHERE table_id = %(table_id)s AND idempotency_key = %(key)s
+        ), state AS (
+            SELECT t.id, {table_weight_sql()} AS weight,
+                   COALESCE(LEAST(%(burst)s, t.enqueue_tokens + %(rate)s / 60.0 * EXTRACT(EPOCH FROM (LOCALTIMESTAMP - t.enqueue_refilled_at))), %(burst)s) AS tokens,
+                   (SELECT COUNT(*) FROM {schema}.queue WHERE table_id = t.id AND status = 'pending') AS pending
+            FROM {schema}.tables t
+            WHERE t.id = %(table_id)s AND t.is_active
+        ), allowed AS (
+            SELECT id, weight, tokens FROM state
+            WHERE NOT EXISTS (SELECT 1 FROM existing)
+              AND (NOT %(limited)s OR (tokens >= 1 AND pending < %(max_pending)s))
+        ), spent AS (
+            UPDATE {schema}.tables t SET enqueue_tokens = a.tokens - 1, enqueue_refilled_at = LOCALTIMESTAMP
+            FROM allowed a
+            WHERE t.id = a.id AND %(limited)s
+        ), inserted AS (
+            INSERT INTO {schema}.queue (song_id, table_id, status, sched_round, idempotency_key)
+            SELECT %(song_id)s, a.id, 'pending', GREATEST(v.round, COALESCE(tl.round, v.round)) + 1.0 / a.weight, %(key)s
+            FROM allowed a,
+                 (SELECT {current_round_sql()} AS round) v,
+                 (SELECT MAX(sched_round) AS round FROM {schema}.queue
+                  WHERE table_id = %(table_id)s AND status IN ('pending', 'playing')) tl
+            RETURNING id, song_id, table_id, status, added_at
+        )
+        SELECT 'created', 0, i.* FROM inserted i
+        UNION ALL
+        SELECT 'duplicate', 0, e.* FROM existing e
+        UNION ALL
+        SELECT CASE WHEN s.tokens < 1 THEN 'rate_limited' ELSE 'quota_exceeded' END,
+               CEIL((1 - LEAST(s.tokens, 1)) * 60.0 / %(rate)s), NULL, NULL, NULL, NULL, NULL
+        FROM state s
+        WHERE NOT EXISTS (SELECT 1 FROM existing) AND NOT EXISTS (SELECT 1 FROM allowed)
+        """,
+        {
+            'song_id': song_id,
+            'table_id': table_id,
+            'key': idempotency_key,
+            'limited': limited,
+            'burst': ENQUEUE_BURST,
+            'rate': ENQUEUE_RATE_PER_MINUTE,
+            'max_pending': MAX_PENDING_PER_TABLE
+        }
+    )
+    row = cursor.fetchone()
+    return (row[0], int(row[1]), row[2:]) if row else None
+
+def lock_pending_items(cursor, ids: list) -> list:
+    '''Блокирует ожидающие треки пачки под тем же advisory-lock, что и переключение трека:
+    advance не выберет трек, который сейчас переставляют. Возвращает id, которые не ожидают'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    cursor.execute(
+        f"""
+        SELECT pg_advisory_xact_lock(hashtext('{schema}.queue_advance'));
+        SELECT id FROM {schema}.queue WHERE id = ANY(%s) AND status = 'pending' ORDER BY id FOR UPDATE
+        """,
+        (ids,)
+    )
+    pending = {row[0] for row in cursor.fetchall()}
+    return [i for i in ids if i not in pending]
+
+def cancel_queue_items(cursor, ids: list, table_id) -> list:
+    '''Снимает ожидающие треки по списку id и/или все ожидающие треки стола. Возвращает снятые id'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    cursor.execute(f"SELECT pg_advisory_xact_lock(hashtext('{schema}.queue_advance'))")
+    execute_prepared(
+        cursor,
+        f"""
+        UPDATE {schema}.queue SET status = 'cancelled'
+        WHERE status = 'pending' AND (id = ANY(%(ids)s::int[]) OR table_id = %(table_id)s)
+        RETURNING id
+        """,
+        {'ids': ids, 'table_id': table_id}
+    )
+    return sorted(row[0] for row in cursor.fetchall())
+
+def reorder_queue_items(cursor, ids: list) -> None:
+    '''Переставляет ожидающие треки в порядке ids. Треки обмениваются своими местами в очереди
+    (раунд и play_order), поэтому чужие треки между ними остаются на месте в любом режиме,
+    а время добавления не меняется'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        WITH wanted AS (
+            SELECT id, position FROM unnest(%(ids)s::int[]) WITH ORDINALITY AS w(id, position)
+        ), slots AS (
+            SELECT sched_round, play_order, ROW_NUMBER() OVER (ORDER BY {queue_order('')}) AS position
+            FROM {schema}.queue
+            WHERE id = ANY(%(ids)s::int[])
+        )
+        UPDATE {schema}.queue q
+        SET sched_round = s.sched_round, play_order = s.play_order
+        FROM wanted w
+        JOIN slots s ON s.position = w.position
+        WHERE q.id = w.id
+        """,
+        {'ids': ids}
+    )
+
+def move_queue_items(cursor, ids: list, table_id) -> bool:
+    '''Переносит ожидающие треки на другой стол. Раунды пересчитываются как при добавлении:
+    треки встают после последнего трека нового стола с его весом. False, если стола нет'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        WITH moved AS (
+            SELECT id, ROW_NUMBER() OVER (ORDER BY {queue_order('')}) AS n
+            FROM {schema}.queue
+            WHERE id = ANY(%(ids)s::int[])
+        )
+        UPDATE {schema}.queue q
+        SET table_id = t.id, sched_round = GREATEST(v.round, COALESCE(tl.round, v.round)) + m.n / t.weight
+        FROM moved m,
+             (SELECT id, {table_weight_sql()} AS weight FROM {schema}.tables WHERE id = %(table_id)s) t,
+             (SELECT {current_round_sql()} AS round) v,
+             (SELECT MAX(sched_round) AS round FROM {schema}.queue
+              WHERE table_id = %(table_id)s AND status IN ('pending', 'playing') AND id <> ALL(%(ids)s::int[])) tl
+        WHERE q.id = m.id
+        """,
+        {'ids': ids, 'table_id': table_id}
+    )
+    return cursor.rowcount > 0
+
+def queue_listing(cursor, table_id, status) -> tuple:
+    '''Треки очереди с фильтром по столу и статусу в порядке воспроизведения.
+    Ожидающим считается время ожидания и ETA. Возвращает (треки, ETA ближайшего трека каждого стола)'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    conditions = []
+    sql_params = {'default_duration': DEFAULT_SONG_SECONDS}
+    if table_id:
+        conditions.append('q.table_id = %(table_id)s')
+        sql_params['table_id'] = table_id
+    if status:
+        conditions.append('q.status = %(status)s')
+        sql_params['status'] = status
+    
+    # Ожидание трека = остаток текущего + сумма длительностей всех ожидающих перед ним
+    query = f"""
+        WITH playing AS (
+            SELECT GREATEST(0, EXTRACT(EPOCH FROM (
+                q.played_at + COALESCE(s.duration, %(default_duration)s) * INTERVAL '1 second' - LOCALTIMESTAMP
+            ))) AS remaining
+            FROM {schema}.queue q
+            JOIN {schema}.songs s ON q.song_id = s.id
+            WHERE q.status = 'playing'
+            ORDER BY q.played_at DESC
+            LIMIT 1
+        ), schedule AS (
+            SELECT q.id,
+                   COALESCE((SELECT remaining FROM playing), 0) + COALESCE(SUM(COALESCE(s.duration, %(default_duration)s)) OVER (
+                       ORDER BY {queue_order()} ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                   ), 0) AS wait_seconds
+            FROM {schema}.queue q
+            JOIN {schema}.songs s ON q.song_id = s.id
+            WHERE q.status = 'pending'
+        )
+        SELECT q.id, q.song_id, q.table_id, q.status, q.added_at, q.played_at,
+               s.title, s.artist, s.genre, s.file_url, s.file_format,
+               t.table_number,
+               ROUND(sc.wait_seconds), LOCALTIMESTAMP + sc.wait_seconds * INTERVAL '1 second'
+        FROM {schema}.queue q
+        JOIN {schema}.songs s ON q.song_id = s.id
+        JOIN {schema}.tables t ON q.table_id = t.id
+        LEFT JOIN schedule sc ON sc.id = q.id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY {queue_order()}
+    """
+    
+    execute_prepared(cursor, query, sql_params)
+    
+    result = []
+    next_up = {}
+    for item in cursor:
+        entry = queue_item(item)
+        if item[12] is not None:
+            entry['wait_seconds'] = int(item[12])
+            entry['eta'] = item[13]
+            next_up.setdefault(str(item[2]), item[13])
+        result.append(entry)
+    return result, next_up
+
+def queue_dashboard(cursor, since) -> dict:
+    '''Сводка для админки одним снимком REPEATABLE READ на одном соединении: столы со счётчиками
+    очереди, ожидающие треки (или только изменения после ревизии since) и статистика каталога'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+    
+    execute_prepared(
+        cursor,
+        f"""
+        SELECT t.id, t.table_number, t.login, t.expires_at, t.is_active, t.created_at,
+               COUNT(q.id) FILTER (WHERE q.status = 'pending'),
+               COALESCE(BOOL_OR(q.status = 'playing'), false)
+        FROM {schema}.tables t
+        LEFT JOIN {schema}.queue q ON q.table_id = t.id AND q.status IN ('pending', 'playing')
+        GROUP BY t.id
+        ORDER BY t.table_number
+        """
+    )
+    tables = [{
+        'id': table[0],
+        'table_number': table[1],
+        'login': table[2],
+        'expires_at': table[3],
+        'is_active': table[4],
+        'created_at': table[5],
+        'pending_count': table[6],
+        'is_playing': table[7]
+    } for table in cursor]
+    
+    execute_prepared(
+        cursor,
+        f"""
+        SELECT (SELECT version FROM {schema}.catalog_version WHERE id = 1),
+               COUNT(*), COUNT(*) FILTER (WHERE track_count IS NULL)
+        FROM {schema}.songs
+        """
+    )
+    catalog_version, song_count, unparsed = cursor.fetchone()
+    execute_prepared(
+        cursor,
+        f"SELECT COALESCE(genre, ''), COUNT(*) FROM {schema}.songs GROUP BY 1 ORDER BY 2 DESC"
+    )
+    genres = dict(cursor.fetchall())
+    
+    # Играющий трек консоль передаёт как current_id при переключении
+    execute_prepared(
+        cursor,
+        f"SELECT id FROM {schema}.queue WHERE status = 'playing' ORDER BY played_at DESC LIMIT 1"
+    )
+    playing = cursor.fetchone()
+    
+    payload = {
+        'tables': tables,
+        'active_tables': sum(1 for t in tables if t['is_active']),
+        'playing_id': playing[0] if playing else None,
+        'catalog': {'version': catalog_version, 'songs': song_count, 'unparsed': unparsed, 'genres': genres}
+    }
+    if since is None:
+        execute_prepared(cursor, f"SELECT COALESCE(MAX(revision), 0) FROM {schema}.queue")
+        payload['revision'] = cursor.fetchone()[0]
+        payload['queue'], payload['next_up'] = queue_listing(cursor, None, 'pending')
+    else:
+        payload['changes'], payload['revision'], payload['has_more'] = queue_changes(cursor, since, None)
+    return payload
+
+def wait_for_queue_change(conn, timeout: float) -> None:
+    '''Ждёт NOTIFY queue_changes не дольше timeout секунд (соединение должно слушать канал)'''
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if select.select([conn], [], [], remaining) == ([], [], []):
+            return
+        conn.poll()
+        if conn.notifies:
+            conn.notifies.clear()
+            return
+
+@instrumented('queue')
 def handler(event: dict, context) -> dict:
     '''API для управления очередью треков по столам'''
     
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return cors_preflight('GET, POST, PUT, DELETE, OPTIONS', f'Content-Type, {SESSION_HEADER}, {IDEMPOTENCY_HEADER}')
     
+    # Очередь читают все. Добавлять и снимать треки может стол (только свои) или администратор,
+    # управлять воспроизведением и смотреть сводку — только администратор. Всё до подключения к БД
+    session = read_session(event)
+    dashboard = method == 'GET' and query_params(event).get('view') == 'dashboard'
+    if method != 'GET' or dashboard:
+        roles = ('admin',) if method == 'PUT' or dashboard else ('admin', 'table')
+        denied = session_denied(session, *roles)
+        if denied:
+            return denied
+    
+    conn = None
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cursor = conn.cursor()
         
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
+            params = query_params(event)
             table_id = params.get('table_id')
             status = params.get('status', 'pending')
             
-            if table_id:
-                query = f"""
-                    SELECT q.id, q.song_id, q.table_id, q.status, q.added_at, q.played_at,
-                           s.title, s.artist, s.genre, s.file_url, s.file_format,
-                           t.table_number
-                    FROM {os.environ['MAIN_DB_SCHEMA']}.queue q
-                    JOIN {os.environ['MAIN_DB_SCHEMA']}.songs s ON q.song_id = s.id
-                    JOIN {os.environ['MAIN_DB_SCHEMA']}.tables t ON q.table_id = t.id
-                    WHERE q.table_id = {table_id}
-                """
-            else:
-                query = f"""
-                    SELECT q.id, q.song_id, q.table_id, q.status, q.added_at, q.played_at,
-                           s.title, s.artist, s.genre, s.file_url, s.file_format,
-                           t.table_number
-                    FROM {os.environ['MAIN_DB_SCHEMA']}.queue q
-                    JOIN {os.environ['MAIN_DB_SCHEMA']}.songs s ON q.song_id = s.id
-                    JOIN {os.environ['MAIN_DB_SCHEMA']}.tables t ON q.table_id = t.id
-                """
-            
-            if status:
-                query += f" WHERE q.status = '{status}'"
-            
-            query += " ORDER BY q.added_at ASC"
-            
-            cursor.execute(query)
-            items = cursor.fetchall()
-            
-            result = []
-            for item in items:
-                result.append({
-                    'id': item[0],
-                    'song_id': item[1],
-                    'table_id': item[2],
-                    'status': item[3],
-                    'added_at': item[4].isoformat() if item[4] else None,
-                    'played_at': item[5].isoformat() if item[5] else None,
-                    'song': {
-                        'title': item[6],
-                        'artist': item[7],
-                        'genre': item[8],
-                        'file_url': item[9],
-                        'file_format': item[10]
-                    },
-                    'table_number': item[11]
-                })
+            if dashboard:
+                try:
+                    since = int(params['since']) if params.get('since') is not None else None
+                except ValueError:
+                    return json_response(400, {'error': 'since must be a number'})
+                return json_response(200, queue_dashboard(cursor, since), event=event)
+            
+            if params.get('since') is not None:
+                try:
+                    since = int(params['since'])
+                    wait = min(float(params.get('wait') or 0), MAX_WAIT_SECONDS)
+                except ValueError:
+                    return json_response(400, {'error': 'since and wait must be numbers'})
+                
+                # LISTEN до первой выборки: изменение между выборкой и ожиданием не потеряется
+                conn.autocommit = True
+                cursor.execute('LISTEN queue_changes')
+                changes, revision, has_more = queue_changes(cursor, since, table_id)
+                if not changes and wait > 0:
+                    wait_for_queue_change(conn, wait)
+                    changes, revision, has_more = queue_changes(cursor, since, table_id)
+                
+                return json_response(200, {'queue': changes, 'revision': revision, 'has_more': has_more}, event=event)
             
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'queue': result}),
-                'isBase64Encoded': False
-            }
+            schema = os.environ['MAIN_DB_SCHEMA']
+            execute_prepared(cursor, f"SELECT COALESCE(MAX(revision), 0) FROM {schema}.queue")
+            revision = cursor.fetchone()[0]
+            
+            result, next_up = queue_listing(cursor, table_id, status)
+            return json_response(200, {'queue': result, 'revision': revision, 'next_up': next_up}, event=event)
         
         elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
+            body = request_body(event)
             song_id = body.get('song_id')
             table_id = body.get('table_id')
             
             if not song_id or not table_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'song_id and table_id required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cursor.execute(
-                f"""
-                INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.queue (song_id, table_id, status)
-                VALUES ({song_id}, {table_id}, 'pending')
-                RETURNING id, song_id, table_id, status, added_at
-                """
-            )
-            new_item = cursor.fetchone()
+                return json_response(400, {'error': 'song_id and table_id required'})
+            
+            if session['role'] == 'table' and str(session['id']) != str(table_id):
+                return json_response(403, {'error': 'Forbidden'})
+            
+            headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+            idempotency_key = headers.get(IDEMPOTENCY_HEADER.lower()) or body.get('idempotency_key')
+            if idempotency_key is not None and (not isinstance(idempotency_key, str) or len(idempotency_key) > MAX_IDEMPOTENCY_KEY_LENGTH):
+                return json_response(400, {'error': f'Idempotency key must be a string up to {MAX_IDEMPOTENCY_KEY_LENGTH} characters'})
+            
+            # Раунд трека: после последнего трека своего стола, но не раньше текущего раунда очереди.
+            # Стол с весом w получает w слотов за раунд. Ограничения действуют на столы, не на администратора
+            enqueued = enqueue_song(cursor, song_id, table_id, idempotency_key, session['role'] == 'table')
+            if not enqueued:
+                conn.rollback()
+                # Сессия стола живёт до expires_at: удалённый или выключенный стол отсекается здесь
+                if session['role'] == 'table':
+                    return json_response(403, {'error': 'Table is no longer active'})
+                return json_response(404, {'error': 'Table not found or inactive'})
+            
+            outcome, retry_after, new_item = enqueued
+            if outcome == 'rate_limited':
+                conn.rollback()
+                return json_response(429, {'error': 'Too many songs added, try again later'}, {
+                    'Retry-After': str(retry_after),
+                    'Access-Control-Expose-Headers': 'Retry-After'
+                })
+            if outcome == 'quota_exceeded':
+                conn.rollback()
+                return json_response(409, {'error': f'Table already has {MAX_PENDING_PER_TABLE} songs waiting'})
             conn.commit()
-            conn.close()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'item': {
-                        'id': new_item[0],
-                        'song_id': new_item[1],
-                        'table_id': new_item[2],
-                        'status': new_item[3],
-                        'added_at': new_item[4].isoformat()
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            item = dict(zip(('id', 'song_id', 'table_id', 'status', 'added_at'), new_item))
+            if outcome == 'duplicate':
+                return json_response(200, {'success': True, 'duplicate': True, 'item': item})
+            return json_response(201, {'success': True, 'item': item})
         
         elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
+            body = request_body(event)
+            
+            if body.get('action') == 'advance':
+                ok, finished, playing = advance_queue(cursor, body.get('current_id'), body.get('next_id'))
+                if not ok:
+                    conn.rollback()
+                    return json_response(409, {'error': 'Queue already advanced by another console'})
+                
+                conn.commit()
+                return json_response(200, {
+                    'success': True,
+                    'finished': finished,
+                    'playing': queue_item(playing) if playing else None
+                })
+            
+            action = body.get('action')
+            if action in ('cancel', 'reorder', 'move'):
+                ids = body.get('ids') or []
+                if not isinstance(ids, list) or len(ids) > MAX_BULK_ITEMS or not all(isinstance(i, int) for i in ids):
+                    return json_response(400, {'error': f'ids must be a list of up to {MAX_BULK_ITEMS} queue ids'})
+                if len(set(ids)) < len(ids):
+                    return json_response(400, {'error': 'ids must be unique'})
+                
+                if action == 'cancel':
+                    if not ids and not body.get('table_id'):
+                        return json_response(400, {'error': 'ids or table_id required'})
+                    cancelled = cancel_queue_items(cursor, ids, body.get('table_id'))
+                    conn.commit()
+                    return json_response(200, {'success': True, 'cancelled': cancelled})
+                
+                if not ids or (action == 'move' and not body.get('table_id')):
+                    return json_response(400, {'error': 'ids required' if action == 'reorder' else 'ids and table_id required'})
+                
+                # Вся пачка в одной транзакции: если хоть один трек уже не ожидает, ничего не меняется
+                not_pending = lock_pending_items(cursor, ids)
+                if not_pending:
+                    conn.rollback()
+                    return json_response(409, {'error': 'Some queue items are no longer pending', 'ids': not_pending})
+                
+                if action == 'reorder':
+                    reorder_queue_items(cursor, ids)
+                elif not move_queue_items(cursor, ids, body['table_id']):
+                    conn.rollback()
+                    return json_response(404, {'error': 'Table not found'})
+                conn.commit()
+                return json_response(200, {'success': True})
+            
             queue_id = body.get('id')
             status = body.get('status')
             
             if not queue_id or not status:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'id and status required'}),
-                    'isBase64Encoded': False
-                }
-            
-            played_at = f", played_at = '{datetime.now().isoformat()}'" if status == 'playing' else ''
-            
-            cursor.execute(
-                f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.queue SET status = '{status}'{played_at} WHERE id = {queue_id}"
+                return json_response(400, {'error': 'id and status required'})
+            
+            # Прежний способ включить трек идёт через advance_queue: под той же блокировкой
+            # и с завершением текущего, иначе играющими оказываются два трека
+            if status == 'playing':
+                ok, finished, playing = advance_queue(cursor, None, queue_id, replace_current=True)
+                if not ok:
+                    conn.rollback()
+                    return json_response(409, {'error': 'Queue item is no longer pending'})
+                conn.commit()
+                return json_response(200, {
+                    'success': True,
+                    'finished': finished,
+                    'playing': queue_item(playing) if playing else None
+                })
+            
+            execute_prepared(
+                cursor,
+                f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.queue SET status = %s WHERE id = %s",
+                (status, queue_id)
             )
             conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
+            
+            return json_response(200, {'success': True})
         
         elif method == 'DELETE':
-            params = event.get('queryStringParameters', {})
+            params = query_params(event)
             queue_id = params.get('id')
             
             if not queue_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Queue ID required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cursor.execute(
-                f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.queue SET status = 'cancelled' WHERE id = {queue_id}"
-            )
+                return json_response(400, {'error': 'Queue ID required'})
+            
+            query = f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.queue SET status = 'cancelled' WHERE id = %s"
+            values = [queue_id]
+            # Стол может снять только свой трек
+            if session['role'] == 'table':
+                query += " AND table_id = %s"
+                values.append(session['id'])
+            execute_prepared(cursor, query, values)
             conn.commit()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
+            
+            return json_response(200, {'success': True})
         
         else:
-            conn.close()
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return json_response(405, {'error': 'Method not allowed'})
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
+    
+    finally:
+        if conn is not None:
+            release_connection(conn)
@@ -1,146 +1,985 @@
+import functools
 import json
 import os
 import psycopg2
-import boto3
+import psycopg2.extensions
+import psycopg2.pool
 import base64
+import gzip
+import hashlib
+import hmac
+import io
+import re
+import time
+from contextlib import contextmanager
+from decimal import Decimal
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SONG_FIELDS = ('id', 'title', 'artist', 'genre', 'file_url', 'file_format', 'duration', 'created_at')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+CATALOG_TTL_SECONDS = 5
+CATALOG_CACHE_MAX_PAGES = 200
+SONG_FORMATS = ('kar', 'mid')
+ARCHIVE_FORMATS = ('zip', 'tar', 'tgz')
+UPLOAD_URL_TTL_SECONDS = 900
+IMPORT_CONCURRENCY = 8
+CONTENT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+UPLOAD_HEADERS = {'ContentType': 'Content-Type', 'CacheControl': 'Cache-Control', 'ChecksumSHA256': 'x-amz-checksum-sha256'}
+CONTENT_KEY_PATTERN = re.compile(r'^karaoke/sha256/([0-9a-f]{64})\.(kar|mid)$')
+
+# Снимок каталога, переживающий тёплые вызовы функции
+_catalog_cache = {'version': None, 'checked_at': 0.0, 'pages': {}}
+_s3 = None
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+TRACE_ENABLED = os.environ.get('TRACE_REQUESTS') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAINABLE = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+# Замеры текущего вызова; None — трассировка выключена и все хуки сводятся к одной проверке
+_trace = None
+
+@contextmanager
+def traced(phase: str):
+    '''Добавляет время блока к фазе запроса (connect, query, serialize, s3)'''
+    if _trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, started)
+
+def add_phase(phase: str, started: float) -> None:
+    if _trace is not None:
+        _trace['phases'][phase] = _trace['phases'].get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+class TracedCursor(psycopg2.extensions.cursor):
+    '''Курсор соединений пула: при включённой трассировке считает запросы и строки,
+    медленные запросы пишет в лог вместе с планом'''
+    def execute(self, query, vars=None):
+        if _trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        add_phase('query', started)
+        _trace['queries'] += 1
+        _trace['rows'] += max(self.rowcount, 0)
+        if elapsed >= SLOW_QUERY_MS:
+            _trace['slow'].append({
+                'sql': prepared_text(self.connection, query),
+                'ms': round(elapsed, 1),
+                'plan': explain_statement(self.connection, query, vars)
+            })
+        return result
+
+def prepared_text(conn, query):
+    '''Для EXECUTE stmt_N — исходный текст подготовленного запроса, параметры в лог не попадают'''
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        name = query.split()[1]
+        for sql, (prepared_name, _) in conn.prepared.items():
+            if prepared_name == name:
+                return sql
+    return query
+
+def explain_statement(conn, query: str, vars):
+    '''План медленного запроса без повторного выполнения; в транзакции — под savepoint, чтобы ошибка EXPLAIN её не сломала'''
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(EXPLAINABLE) or ';' in query.rstrip().rstrip(';'):
+        return None
+    savepoint = not conn.autocommit and conn.status != psycopg2.extensions.STATUS_READY
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT trace_explain')
+            cursor.execute('EXPLAIN ' + query, vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT trace_explain')
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return str(e)
+
+def instrumented(function_name: str):
+    '''Обёртка handler: при TRACE_REQUESTS=1 отдаёт фазы в заголовке Server-Timing
+    и пишет одну структурированную строку лога на вызов'''
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            global _trace
+            _trace = {'phases': {}, 'queries': 0, 'rows': 0, 'slow': []}
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                trace, _trace = _trace, None
+            total = (time.perf_counter() - started) * 1000
+            
+            timing = [f'{phase};dur={ms:.1f}' for phase, ms in trace['phases'].items()]
+            timing.append(f'total;dur={total:.1f}')
+            timing.append(f"db;desc=\"{trace['queries']} queries, {trace['rows']} rows\"")
+            response['headers'] = {**response.get('headers', {}), 'Server-Timing': ', '.join(timing), 'Timing-Allow-Origin': '*'}
+            print(json.dumps({
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'status': response['statusCode'],
+                'total_ms': round(total, 1),
+                'phases': {phase: round(ms, 1) for phase, ms in trace['phases'].items()},
+                'queries': trace['queries'],
+                'rows': trace['rows'],
+                'slow_queries': trace['slow'],
+                'error': json.loads(response['body']).get('error') if response['statusCode'] >= 500 and not response['isBase64Encoded'] else None
+            }, ensure_ascii=False, default=str))
+            return response
+        return wrapper
+    return decorate
+
+def json_default(value):
+    '''Типы из БД, которых нет в JSON: даты в ISO 8601, numeric в число'''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def encode_json(payload) -> bytes:
+    '''JSON в UTF-8 одним вызовом кодировщика: orjson, если установлен, иначе стандартный json'''
+    with traced('serialize'):
+        if orjson is not None:
+            return orjson.dumps(payload, default=json_default)
+        return json.dumps(payload, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def response_encoding(event, body: bytes):
+    '''Сжатие под Accept-Encoding клиента: br, если доступен brotli, иначе gzip; маленькие тела не сжимаются'''
+    if not event or len(body) < COMPRESS_MIN_BYTES:
+        return None
+    header = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'accept-encoding'), '')
+    accepted = set()
+    for part in header.split(','):
+        name, _, weight = part.strip().partition(';')
+        if weight.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    if 'br' in accepted and brotli is not None:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def encoded_body(body: bytes, encoding) -> str:
+    '''Тело ответа шлюзу: UTF-8 как есть или сжатое и в base64'''
+    if encoding is None:
+        return body.decode('utf-8')
+    with traced('compress'):
+        packed = brotli.compress(body, quality=BROTLI_QUALITY) if encoding == 'br' else gzip.compress(body, GZIP_LEVEL, mtime=0)
+    return base64.b64encode(packed).decode('ascii')
+
+def json_response(status: int, payload, headers: dict = None, event: dict = None) -> dict:
+    '''Ответ API в JSON с CORS-заголовками. С event большое тело сжимается под Accept-Encoding клиента'''
+    body = encode_json(payload)
+    encoding = response_encoding(event, body)
+    compression = {'Content-Encoding': encoding} if encoding else {}
+    negotiated = {'Vary': 'Accept-Encoding'} if event else {}
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **negotiated, **compression, **(headers or {})},
+        'body': encoded_body(body, encoding),
+        'isBase64Encoded': encoding is not None
+    }
+
+def cors_preflight(methods: str, allow_headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS-запрос браузера'''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def request_body(event: dict) -> dict:
+    '''JSON-тело запроса; пустое тело — пустой словарь'''
+    return json.loads(event.get('body') or '{}')
+
+def query_params(event: dict) -> dict:
+    '''Параметры строки запроса; шлюз передаёт None, если их нет'''
+    return event.get('queryStringParameters') or {}
+
+SESSION_HEADER = 'X-Session-Token'
+
+def b64url(raw: bytes) -> str:
+    '''base64url без выравнивающих "="'''
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def session_signature(payload: str) -> str:
+    '''HMAC-SHA256 от полезной нагрузки токена на общем секрете функций'''
+    secret = os.environ['SESSION_SECRET'].encode('utf-8')
+    return b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+def read_session(event: dict):
+    '''Claims из заголовка X-Session-Token; None, если токена нет, он не разбирается, подпись не сошлась или срок истёк'''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    payload, _, signature = (headers.get(SESSION_HEADER.lower()) or '').partition('.')
+    # Не-ASCII в токене ломает кодирование и compare_digest: такой токен просто не принимается
+    try:
+        if not payload or not hmac.compare_digest(signature.encode('ascii'), session_signature(payload).encode('ascii')):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('expires_at', 0) <= time.time():
+        return None
+    return claims
+
+def session_denied(session, *roles):
+    '''Ответ 401/403, если сессии нет или её роль не подходит; None — доступ разрешён'''
+    if session is None:
+        return json_response(401, {'error': 'Session token required'})
+    if session['role'] not in roles:
+        return json_response(403, {'error': 'Forbidden'})
+    return None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_PING_AFTER_SECONDS = 30
+# Потолок подготовленных операторов на соединение: каждый занимает память бэкенда Postgres
+PREPARED_CACHE_SIZE = 64
+
+# Пул соединений инстанса: переживает тёплые вызовы, одно соединение держится открытым
+_db_pool = None
+_db_last_used = {}
+
+SQL_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула с кэшем подготовленных операторов: кэш живёт ровно столько, сколько сессия Postgres'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_total = 0
+        self.cursor_factory = TracedCursor
+
+def execute_prepared(cursor, sql: str, params=()):
+    '''Выполняет запрос через PREPARE/EXECUTE. Разбор и план строятся один раз на соединение,
+    тёплые вызовы функции с тем же соединением из пула только подставляют параметры.
+    Плейсхолдеры как у psycopg2: %s или %(name)s'''
+    conn = cursor.connection
+    statements = conn.prepared
+    if sql in statements:
+        # Порядок словаря — порядок использования: вытесняется самый давно не нужный оператор
+        statements[sql] = statements.pop(sql)
+    else:
+        if len(statements) >= PREPARED_CACHE_SIZE:
+            evicted, _ = statements.pop(next(iter(statements)))
+            cursor.execute(f'DEALLOCATE {evicted}')
+        keys = []
+        
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) else len(keys)
+            if key not in keys:
+                keys.append(key)
+            return f'${keys.index(key) + 1}'
+        
+        # Имя из счётчика соединения, а не из размера кэша: после вытеснения размер повторяется
+        name = f'stmt_{conn.prepared_total}'
+        conn.prepared_total += 1
+        cursor.execute(f'PREPARE {name} AS {SQL_PLACEHOLDER.sub(number, sql)}')
+        statements[sql] = (name, keys)
+    
+    name, keys = statements[sql]
+    values = [params[key] for key in keys]
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}', values)
+
+def get_connection():
+    '''Соединение из пула; простоявшее дольше DB_PING_AFTER_SECONDS проверяется перед выдачей'''
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, DB_POOL_SIZE, os.environ['DATABASE_URL'], connection_factory=PreparedConnection
+        )
+    
+    with traced('connect'):
+        conn = _db_pool.getconn()
+        last_used = _db_last_used.pop(id(conn), None)
+        if conn.closed or (last_used and time.monotonic() - last_used > DB_PING_AFTER_SECONDS and not ping_connection(conn)):
+            _db_pool.putconn(conn, close=True)
+            conn = _db_pool.getconn()
+    return conn
+
+def ping_connection(conn) -> bool:
+    '''Живо ли соединение после простоя'''
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул в чистом состоянии; сломанное закрывается'''
+    try:
+        if not conn.closed:
+            conn.rollback()
+            if conn.autocommit:
+                with conn.cursor() as cursor:
+                    cursor.execute('UNLISTEN *')
+                conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+    _db_last_used[id(conn)] = time.monotonic()
+    _db_pool.putconn(conn, close=bool(conn.closed))
+
+def s3_client():
+    '''S3-клиент бакета, создаётся один раз на инстанс; boto3 импортируется только при первой работе с бакетом'''
+    global _s3
+    if _s3 is None:
+        import boto3
+        _s3 = boto3.client('s3',
+            endpoint_url='https://bucket.poehali.dev',
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+        if TRACE_ENABLED:
+            _s3.meta.events.register('before-call.s3', s3_call_started)
+            _s3.meta.events.register('after-call.s3', s3_call_finished)
+    return _s3
+
+def s3_call_started(context: dict, **kwargs) -> None:
+    context['trace_started'] = time.perf_counter()
+
+def s3_call_finished(context: dict, **kwargs) -> None:
+    '''Время вызова S3 от подписи запроса до разбора ответа, включая повторы'''
+    if 'trace_started' in context:
+        add_phase('s3', context.pop('trace_started'))
+
+def public_url(file_key: str) -> str:
+    '''CDN-ссылка на объект бакета'''
+    return f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
+
+def bump_catalog_version(cursor) -> None:
+    '''Увеличивает версию каталога в текущей транзакции'''
+    execute_prepared(
+        cursor,
+        f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.catalog_version SET version = version + 1, updated_at = CURRENT_TIMESTAMP WHERE id = 1"
+    )
+    _catalog_cache['checked_at'] = 0.0
+
+def content_key(content_hash: str, file_format: str) -> str:
+    '''Ключ объекта по SHA-256 содержимого: одинаковые файлы хранятся один раз'''
+    return f"karaoke/sha256/{content_hash}.{file_format}"
+
+def store_object(file_key: str, data: bytes, file_format: str) -> bool:
+    '''Кладёт файл в бакет, если такого объекта ещё нет. True, если файл загружен'''
+    s3 = s3_client()
+    try:
+        s3.head_object(Bucket='files', Key=file_key)
+        return False
+    except s3_client().exceptions.ClientError:
+        s3.put_object(
+            Bucket='files',
+            Key=file_key,
+            Body=data,
+            ContentType=f'audio/{file_format}',
+            CacheControl=CONTENT_CACHE_CONTROL
+        )
+        return True
+
+def uploaded_object_hash(file_key: str) -> str:
+    '''SHA-256 загруженного объекта: из контрольной суммы S3, иначе потоковым чтением'''
+    s3 = s3_client()
+    head = s3.head_object(Bucket='files', Key=file_key, ChecksumMode='ENABLED')
+    if head.get('ChecksumSHA256'):
+        return base64.b64decode(head['ChecksumSHA256']).hex()
+    
+    digest = hashlib.sha256()
+    for chunk in s3.get_object(Bucket='files', Key=file_key)['Body'].iter_chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def song_metadata(stream):
+    '''Длительность, темп, треки и текст из .kar/.mid; None, если файл не разбирается'''
+    # Разбор, импорт и архивы нужны только загрузке: чтение каталога не платит за их импорт на холодном старте
+    from midi import read_smf
+    try:
+        return read_smf(stream)
+    except ValueError:
+        return None
+
+def object_metadata(file_key: str):
+    '''Разбирает объект бакета, читая его потоком'''
+    return song_metadata(s3_client().get_object(Bucket='files', Key=file_key)['Body'])
+
+def verified_object_metadata(file_key: str, content_hash: str):
+    '''Метаданные объекта из манифеста после сверки его SHA-256 с ключом: иначе дедупликация по содержимому ломается'''
+    if uploaded_object_hash(file_key) != content_hash:
+        raise ValueError('Uploaded file does not match its content hash')
+    return object_metadata(file_key)
+
+def save_lyrics(cursor, songs: list) -> None:
+    '''Сохраняет извлечённый текст песен одним запросом: songs — список (song_id, metadata)'''
+    from psycopg2.extras import execute_values
+    rows = [
+        (song_id, midi['lyrics'], json.dumps(midi['lyric_lines'], ensure_ascii=False))
+        for song_id, midi in songs if midi and midi['lyrics']
+    ]
+    if rows:
+        execute_values(
+            cursor,
+            f"""
+            INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.song_lyrics (song_id, lyrics, lines) VALUES %s
+            ON CONFLICT (song_id) DO UPDATE SET lyrics = EXCLUDED.lyrics, lines = EXCLUDED.lines
+            """,
+            rows
+        )
+
+def metadata_columns(midi) -> tuple:
+    '''Значения duration, tempo_bpm, track_count, channel_count для строки songs'''
+    if not midi:
+        return (None, None, None, None)
+    return (midi['duration'], midi['tempo_bpm'], midi['track_count'], midi['channel_count'])
+
+def search_lyrics(cursor, fragment: str, fields: list, limit: int) -> list:
+    '''Поиск трека по строчке песни: сначала точная фраза, затем все слова в любом порядке'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        SELECT {', '.join('s.' + f for f in fields)},
+               ts_headline('simple', l.lyrics, query, 'StartSel=«, StopSel=», MaxWords=12, MinWords=4')
+        FROM {schema}.song_lyrics l
+        JOIN {schema}.songs s ON s.id = l.song_id,
+             plainto_tsquery('simple', %s) query,
+             phraseto_tsquery('simple', %s) phrase
+        WHERE l.search_vector @@ query
+        ORDER BY l.search_vector @@ phrase DESC, ts_rank(l.search_vector, query) DESC, s.id
+        LIMIT %s
+        """,
+        (fragment, fragment, limit)
+    )
+    return [{**dict(zip(fields, song)), 'snippet': song[-1]} for song in cursor]
+
+def backfill_metadata(cursor, batch_size: int) -> dict:
+    '''Разбирает файлы треков, загруженных до извлечения метаданных, пачками по batch_size.
+    Неразбираемые файлы помечаются track_count = 0, поэтому повторный вызов продолжает с места остановки.'''
+    from concurrent.futures import ThreadPoolExecutor
+    from psycopg2.extras import execute_values
+    schema = os.environ['MAIN_DB_SCHEMA']
+    prefix = public_url('')
+    cursor.execute(
+        f"SELECT id, file_url FROM {schema}.songs WHERE track_count IS NULL ORDER BY id LIMIT %s",
+        (batch_size,)
+    )
+    songs = cursor.fetchall()
+    
+    def fetch(file_url):
+        if not file_url or not file_url.startswith(prefix):
+            return None
+        try:
+            return object_metadata(file_url[len(prefix):])
+        except s3_client().exceptions.ClientError:
+            return None
+    
+    with ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY) as pool:
+        parsed = list(pool.map(fetch, [song[1] for song in songs]))
+    
+    if songs:
+        execute_values(
+            cursor,
+            f"""
+            UPDATE {schema}.songs AS s
+            SET duration = COALESCE(v.duration, s.duration), tempo_bpm = v.tempo_bpm,
+                track_count = v.track_count, channel_count = v.channel_count
+            FROM (VALUES %s) AS v (id, duration, tempo_bpm, track_count, channel_count)
+            WHERE s.id = v.id
+            """,
+            [
+                (song[0],) + (metadata_columns(midi) if midi else (None, None, 0, 0))
+                for song, midi in zip(songs, parsed)
+            ],
+            template='(%s, %s::integer, %s::numeric, %s::smallint, %s::smallint)',
+            page_size=len(songs)
+        )
+        save_lyrics(cursor, [(song[0], midi) for song, midi in zip(songs, parsed)])
+        bump_catalog_version(cursor)
+    
+    return {
+        'processed': len(songs),
+        'parsed': sum(1 for midi in parsed if midi),
+        'with_lyrics': sum(1 for midi in parsed if midi and midi['lyrics']),
+        'remaining': len(songs) == batch_size
+    }
+
+def find_song_by_hash(cursor, content_hash: str):
+    '''Трек с таким же содержимым, если он уже есть в библиотеке'''
+    execute_prepared(
+        cursor,
+        f"SELECT id, title, artist, genre, file_url, file_format FROM {os.environ['MAIN_DB_SCHEMA']}.songs WHERE content_hash = %s",
+        (content_hash,)
+    )
+    song = cursor.fetchone()
+    if not song:
+        return None
+    return dict(zip(('id', 'title', 'artist', 'genre', 'file_url', 'file_format'), song))
+
+def iter_archive(archive_file):
+    '''Поочерёдно отдаёт (имя, байты) треков .kar/.mid из zip или tar архива'''
+    import tarfile
+    import zipfile
+    suffixes = tuple(f'.{fmt}' for fmt in SONG_FORMATS)
+    if zipfile.is_zipfile(archive_file):
+        archive_file.seek(0)
+        with zipfile.ZipFile(archive_file) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(suffixes):
+                    yield info.filename, archive.read(info)
+    else:
+        archive_file.seek(0)
+        with tarfile.open(fileobj=archive_file, mode='r:*') as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(suffixes):
+                    yield member.name, archive.extractfile(member).read()
+
+def song_entry(name: str, file_key: str, meta: dict, genre: str) -> dict:
+    '''Описание импортируемого трека; без манифеста берётся из имени "Исполнитель - Название.kar"'''
+    stem = os.path.splitext(os.path.basename(name))[0]
+    artist, sep, title = stem.partition(' - ')
+    if not sep:
+        artist, title = 'Неизвестный исполнитель', stem
+    return {
+        'name': name,
+        'file_key': file_key,
+        'file_format': file_key.rsplit('.', 1)[-1].lower(),
+        'title': meta.get('title') or title.strip(),
+        'artist': meta.get('artist') or artist.strip(),
+        'genre': meta.get('genre') or genre,
+        'status': 'pending'
+    }
+
+def import_songs(cursor, archive_key: str, manifest: list, genre: str) -> list:
+    '''Массовый импорт треков из архива в бакете или по манифесту уже загруженных файлов.
+    Треки, содержимое которых уже есть в библиотеке, пропускаются, поэтому импорт можно повторить.'''
+    import tempfile
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from psycopg2.extras import execute_values
+    schema = os.environ['MAIN_DB_SCHEMA']
+    s3 = s3_client()
+    meta = {m['name']: m for m in manifest if m.get('name')}
+    entries = []
+    seen = set()
+    
+    with ThreadPoolExecutor(max_workers=IMPORT_CONCURRENCY) as pool:
+        if archive_key:
+            slots = threading.BoundedSemaphore(IMPORT_CONCURRENCY * 2)
+            
+            with tempfile.TemporaryFile() as archive_file:
+                s3.download_fileobj('files', archive_key, archive_file)
+                for name, data in iter_archive(archive_file):
+                    file_format = name.rsplit('.', 1)[-1].lower()
+                    content_hash = hashlib.sha256(data).hexdigest()
+                    entry = song_entry(name, content_key(content_hash, file_format), meta.get(name, {}), genre)
+                    entry['content_hash'] = content_hash
+                    entry['midi'] = song_metadata(io.BytesIO(data))
+                    entries.append(entry)
+                    if content_hash in seen:
+                        continue
+                    seen.add(content_hash)
+                    slots.acquire()
+                    entry['future'] = pool.submit(store_object, entry['file_key'], data, file_format)
+                    entry['future'].add_done_callback(lambda _: slots.release())
+        else:
+            for item in manifest:
+                file_key = item.get('file_key') or ''
+                entry = song_entry(item.get('name') or file_key, file_key, item, genre)
+                entries.append(entry)
+                match = CONTENT_KEY_PATTERN.match(file_key)
+                if not match:
+                    entry['status'] = 'failed'
+                    entry['error'] = 'Invalid file_key'
+                    continue
+                entry['content_hash'] = match.group(1)
+                if entry['content_hash'] in seen:
+                    continue
+                seen.add(entry['content_hash'])
+                entry['future'] = pool.submit(verified_object_metadata, file_key, entry['content_hash'])
+    
+    rows = []
+    for entry in entries:
+        future = entry.pop('future', None)
+        if future is None:
+            continue
+        if future.exception():
+            entry['status'] = 'failed'
+            entry['error'] = str(future.exception())
+        else:
+            if 'midi' not in entry:
+                entry['midi'] = future.result()
+            rows.append(entry)
+    
+    cursor.execute(
+        f"SELECT content_hash, id FROM {schema}.songs WHERE content_hash = ANY(%s)",
+        ([e['content_hash'] for e in rows],)
+    )
+    ids = dict(cursor.fetchall())
+    new_rows = [e for e in rows if e['content_hash'] not in ids]
+    
+    inserted = set()
+    if new_rows:
+        for content_hash, song_id in execute_values(
+            cursor,
+            f"""
+            INSERT INTO {schema}.songs
+            (title, artist, genre, file_url, file_format, content_hash, duration, tempo_bpm, track_count, channel_count)
+            VALUES %s
+            ON CONFLICT (content_hash) WHERE content_hash IS NOT NULL DO NOTHING
+            RETURNING content_hash, id
+            """,
+            [
+                (e['title'], e['artist'], e['genre'], public_url(e['file_key']), e['file_format'], e['content_hash'])
+                + metadata_columns(e['midi'])
+                for e in new_rows
+            ],
+            page_size=len(new_rows),
+            fetch=True
+        ):
+            ids[content_hash] = song_id
+            inserted.add(content_hash)
+        if inserted:
+            save_lyrics(cursor, [(ids[e['content_hash']], e['midi']) for e in new_rows if e['content_hash'] in inserted])
+            bump_catalog_version(cursor)
+    
+    # Первый трек с данным содержимым считается импортированным, его копии — пропущенными
+    for entry in entries:
+        if entry['status'] != 'pending':
+            continue
+        if entry['content_hash'] not in ids:
+            entry['status'] = 'failed'
+            entry['error'] = 'Upload failed'
+            continue
+        entry['id'] = ids[entry['content_hash']]
+        entry['status'] = 'imported' if entry['content_hash'] in inserted else 'skipped'
+        inserted.discard(entry['content_hash'])
+    
+    return [
+        {k: entry[k] for k in ('name', 'status', 'id', 'title', 'artist', 'error') if k in entry}
+        for entry in entries
+    ]
+
+def duplicate_song_response(song: dict) -> dict:
+    '''Ответ на загрузку файла, который уже есть в библиотеке'''
+    return json_response(200, {'success': True, 'duplicate': True, 'song': song})
+
+def store_catalog_page(event: dict, page_key: str, payload: dict) -> dict:
+    '''Кладёт страницу в снимок каталога и отдаёт её с ETag'''
+    if len(_catalog_cache['pages']) >= CATALOG_CACHE_MAX_PAGES:
+        _catalog_cache['pages'] = {}
+    # JSON страницы и её тела под каждое Accept-Encoding: сжатие делается один раз на версию каталога
+    _catalog_cache['pages'][page_key] = (encode_json(payload), {})
+    return catalog_cache_response(event, page_key)
+
+def catalog_cache_response(event: dict, page_key: str):
+    '''Ответ по снимку каталога: 304 по совпавшему ETag или страница из памяти'''
+    version = _catalog_cache['version']
+    if version is None:
+        return None
+    
+    etag = f'"{version}"'
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    response_headers = {
+        'Content-Type': 'application/json',
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Expose-Headers': 'ETag',
+        'Cache-Control': 'no-cache',
+        'ETag': etag,
+        'Vary': 'Accept-Encoding'
+    }
+    
+    if headers.get('if-none-match') == etag:
+        return {'statusCode': 304, 'headers': response_headers, 'body': '', 'isBase64Encoded': False}
+    
+    page = _catalog_cache['pages'].get(page_key)
+    if page is None:
+        return None
+    
+    body, encoded = page
+    encoding = response_encoding(event, body)
+    if encoding not in encoded:
+        encoded[encoding] = encoded_body(body, encoding)
+    if encoding:
+        response_headers['Content-Encoding'] = encoding
+    return {'statusCode': 200, 'headers': response_headers, 'body': encoded[encoding], 'isBase64Encoded': encoding is not None}
+
+@instrumented('songs')
 def handler(event: dict, context) -> dict:
     '''API для управления библиотекой треков караоке (.kar, .mid файлы)'''
     
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return cors_preflight('GET, POST, DELETE, OPTIONS', f'Content-Type, If-None-Match, {SESSION_HEADER}')
     
+    # Каталог читают все; загрузка и импорт — только по сессии администратора
+    if method != 'GET':
+        denied = session_denied(read_session(event), 'admin')
+        if denied:
+            return denied
+    
+    conn = None
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        if method == 'GET':
+            page_key = json.dumps(query_params(event), sort_keys=True)
+            if time.monotonic() - _catalog_cache['checked_at'] < CATALOG_TTL_SECONDS:
+                cached = catalog_cache_response(event, page_key)
+                if cached:
+                    return cached
+        
+        conn = get_connection()
         cursor = conn.cursor()
         
         if method == 'GET':
-            params = event.get('queryStringParameters', {})
+            execute_prepared(cursor, f"SELECT version FROM {os.environ['MAIN_DB_SCHEMA']}.catalog_version WHERE id = 1")
+            version = cursor.fetchone()[0]
+            if version != _catalog_cache['version']:
+                _catalog_cache['pages'] = {}
+            _catalog_cache['version'] = version
+            _catalog_cache['checked_at'] = time.monotonic()
+            
+            cached = catalog_cache_response(event, page_key)
+            if cached:
+                return cached
+            
+            params = query_params(event)
             search = params.get('search', '')
             genre = params.get('genre', '')
             
-            query = f"SELECT id, title, artist, genre, file_url, file_format, duration, created_at FROM {os.environ['MAIN_DB_SCHEMA']}.songs WHERE 1=1"
+            # Поля в порядке SONG_FIELDS и без повторов: иначе каждая перестановка — новый подготовленный оператор
+            requested = params.get('fields', '').split(',')
+            fields = [f for f in SONG_FIELDS if f in requested] or list(SONG_FIELDS)
+            columns = fields + [c for c in ('artist', 'title', 'id') if c not in fields]
+            
+            try:
+                limit = max(1, min(int(params.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+                after = json.loads(base64.urlsafe_b64decode(params['cursor'])) if params.get('cursor') else None
+                if after is not None and (not isinstance(after, list) or len(after) != 3):
+                    raise ValueError('cursor')
+            except (ValueError, TypeError):
+                return json_response(400, {'error': 'Invalid limit or cursor'})
+            
+            if params.get('lyrics'):
+                result = search_lyrics(cursor, params['lyrics'], fields, limit)
+                return store_catalog_page(event, page_key, {'songs': result, 'next_cursor': None})
+            
+            schema = os.environ['MAIN_DB_SCHEMA']
+            query = f"SELECT {', '.join(columns)} FROM {schema}.songs WHERE 1=1"
+            sql_params = []
             
             if search:
-                query += f" AND (title ILIKE '%{search}%' OR artist ILIKE '%{search}%')"
+                query += (
+                    f" AND (search_text LIKE '%%' || {schema}.karaoke_translit(%s) || '%%'"
+                    f" OR {schema}.karaoke_translit(%s) <%% search_text)"
+                )
+                sql_params += [search, search]
             
             if genre:
-                query += f" AND genre = '{genre}'"
-            
-            query += " ORDER BY artist, title"
-            
-            cursor.execute(query)
-            songs = cursor.fetchall()
-            
-            result = []
-            for song in songs:
-                result.append({
-                    'id': song[0],
-                    'title': song[1],
-                    'artist': song[2],
-                    'genre': song[3],
-                    'file_url': song[4],
-                    'file_format': song[5],
-                    'duration': song[6],
-                    'created_at': song[7].isoformat() if song[7] else None
-                })
+                query += " AND genre = %s"
+                sql_params.append(genre)
+            
+            if search:
+                # Поисковая выдача ранжирована по похожести, курсор к ней не применяется
+                query += f" ORDER BY word_similarity({schema}.karaoke_translit(%s), search_text) DESC, artist, title"
+                sql_params.append(search)
+            else:
+                if after:
+                    query += " AND (artist, title, id) > (%s, %s, %s)"
+                    sql_params += after
+                query += " ORDER BY artist, title, id"
             
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'songs': result}),
-                'isBase64Encoded': False
-            }
+            query += " LIMIT %s"
+            sql_params.append(limit + 1)
+            
+            execute_prepared(cursor, query, sql_params)
+            songs = cursor.fetchmany(limit)
+            has_more = cursor.fetchone() is not None
+            
+            # columns начинаются с fields, zip отбрасывает служебные колонки сортировки
+            result = [dict(zip(fields, song)) for song in songs]
+            
+            next_cursor = None
+            if has_more and not search:
+                last = dict(zip(columns, songs[-1]))
+                next_cursor = base64.urlsafe_b64encode(
+                    json.dumps([last['artist'], last['title'], last['id']]).encode('utf-8')
+                ).decode('ascii')
+            
+            return store_catalog_page(event, page_key, {'songs': result, 'next_cursor': next_cursor})
         
         elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
+            body = request_body(event)
+            action = body.get('action', 'upload')
             title = body.get('title')
             artist = body.get('artist')
             genre = body.get('genre', 'Без жанра')
             file_format = body.get('file_format')
-            file_data = body.get('file_data')
-            
-            if not title or not artist or not file_data or not file_format:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Title, artist, file_format and file_data required'}),
-                    'isBase64Encoded': False
-                }
             
-            s3 = boto3.client('s3',
-                endpoint_url='https://bucket.poehali.dev',
-                aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
-            )
+            if action == 'backfill_metadata':
+                stats = backfill_metadata(cursor, max(1, min(int(body.get('batch_size') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE)))
+                conn.commit()
+                
+                return json_response(200, {'success': True, **stats})
             
-            file_bytes = base64.b64decode(file_data)
-            file_key = f"karaoke/{artist}_{title}.{file_format}"
+            if action == 'import':
+                archive_key = body.get('archive_key')
+                manifest = body.get('manifest') or []
+                
+                if (not archive_key and not manifest) or (archive_key and not archive_key.startswith('karaoke/archives/')):
+                    return json_response(400, {'error': 'archive_key or manifest required'})
+                
+                results = import_songs(cursor, archive_key, manifest, genre)
+                conn.commit()
+                
+                return json_response(200, {
+                    'success': True,
+                    'imported': sum(1 for r in results if r['status'] == 'imported'),
+                    'skipped': sum(1 for r in results if r['status'] == 'skipped'),
+                    'failed': sum(1 for r in results if r['status'] == 'failed'),
+                    'results': results
+                })
             
-            s3.put_object(
-                Bucket='files',
-                Key=file_key,
-                Body=file_bytes,
-                ContentType=f'audio/{file_format}'
-            )
+            if file_format not in SONG_FORMATS and not (action == 'upload_url' and file_format in ARCHIVE_FORMATS):
+                return json_response(400, {'error': 'file_format must be kar or mid'})
+            
+            if action == 'upload_url':
+                if file_format in ARCHIVE_FORMATS:
+                    import uuid
+                    file_key = f"karaoke/archives/{uuid.uuid4().hex}.{file_format}"
+                    upload_params = {'ContentType': 'application/octet-stream'}
+                else:
+                    content_hash = (body.get('content_hash') or '').lower()
+                    if not re.fullmatch(r'[0-9a-f]{64}', content_hash):
+                        return json_response(400, {'error': 'content_hash (SHA-256 hex) required'})
+                    
+                    existing = find_song_by_hash(cursor, content_hash)
+                    if existing:
+                        return duplicate_song_response(existing)
+                    
+                    file_key = content_key(content_hash, file_format)
+                    upload_params = {
+                        'ContentType': f'audio/{file_format}',
+                        'CacheControl': CONTENT_CACHE_CONTROL,
+                        'ChecksumSHA256': base64.b64encode(bytes.fromhex(content_hash)).decode('ascii')
+                    }
+                
+                upload_url = s3_client().generate_presigned_url(
+                    'put_object',
+                    Params={'Bucket': 'files', 'Key': file_key, **upload_params},
+                    ExpiresIn=UPLOAD_URL_TTL_SECONDS
+                )
+                return json_response(200, {
+                    'success': True,
+                    'upload_url': upload_url,
+                    'file_key': file_key,
+                    'upload_headers': {UPLOAD_HEADERS[k]: v for k, v in upload_params.items()},
+                    'expires_in': UPLOAD_URL_TTL_SECONDS
+                })
+            
+            if action == 'finalize':
+                match = CONTENT_KEY_PATTERN.match(body.get('file_key') or '')
+                
+                if not title or not artist or not match or match.group(2) != file_format:
+                    return json_response(400, {'error': 'Title, artist, file_format and file_key required'})
+                
+                file_key = match.group(0)
+                content_hash = match.group(1)
+                try:
+                    uploaded_hash = uploaded_object_hash(file_key)
+                except s3_client().exceptions.ClientError:
+                    return json_response(404, {'error': 'Uploaded file not found'})
+                
+                if uploaded_hash != content_hash:
+                    return json_response(400, {'error': 'Uploaded file does not match its content hash'})
+                
+                file_bytes = None
+                midi = object_metadata(file_key)
             
-            cdn_url = f"https://cdn.poehali.dev/projects/{os.environ['AWS_ACCESS_KEY_ID']}/bucket/{file_key}"
+            else:
+                file_data = body.get('file_data')
+                
+                if not title or not artist or not file_data:
+                    return json_response(400, {'error': 'Title, artist, file_format and file_data required'})
+                
+                file_bytes = base64.b64decode(file_data)
+                content_hash = hashlib.sha256(file_bytes).hexdigest()
+                file_key = content_key(content_hash, file_format)
+                midi = song_metadata(io.BytesIO(file_bytes))
             
-            cursor.execute(
+            existing = find_song_by_hash(cursor, content_hash)
+            if existing:
+                return duplicate_song_response(existing)
+            
+            if file_bytes is not None:
+                store_object(file_key, file_bytes, file_format)
+            
+            execute_prepared(
+                cursor,
                 f"""
                 INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.songs 
-                (title, artist, genre, file_url, file_format) 
-                VALUES ('{title}', '{artist}', '{genre}', '{cdn_url}', '{file_format}')
-                RETURNING id, title, artist, genre, file_url, file_format
-                """
+                (title, artist, genre, file_url, file_format, content_hash, duration, tempo_bpm, track_count, channel_count) 
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (content_hash) WHERE content_hash IS NOT NULL DO NOTHING
+                RETURNING id, title, artist, genre, file_url, file_format, duration
+                """,
+                (title, artist, genre, public_url(file_key), file_format, content_hash) + metadata_columns(midi)
             )
             new_song = cursor.fetchone()
+            if not new_song:
+                existing = find_song_by_hash(cursor, content_hash)
+                return duplicate_song_response(existing)
+            
+            save_lyrics(cursor, [(new_song[0], midi)])
+            bump_catalog_version(cursor)
             conn.commit()
-            conn.close()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'song': {
-                        'id': new_song[0],
-                        'title': new_song[1],
-                        'artist': new_song[2],
-                        'genre': new_song[3],
-                        'file_url': new_song[4],
-                        'file_format': new_song[5]
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            return json_response(201, {
+                'success': True,
+                'song': {
+                    'id': new_song[0],
+                    'title': new_song[1],
+                    'artist': new_song[2],
+                    'genre': new_song[3],
+                    'file_url': new_song[4],
+                    'file_format': new_song[5],
+                    'duration': new_song[6]
+                }
+            })
         
         else:
-            conn.close()
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return json_response(405, {'error': 'Method not allowed'})
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        return json_response(500, {'error': str(e)})
+    
+    finally:
+        if conn is not None:
+            release_connection(conn)
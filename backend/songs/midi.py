@@ -0,0 +1,147 @@
+import struct
+
+DEFAULT_TEMPO = 500000  # мкс на четверть, 120 BPM по стандарту SMF
+
+def read_varlen(data: bytes, pos: int) -> tuple:
+    '''Число переменной длины (VLQ) из трека, возвращает (значение, новая позиция)'''
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            return value, pos
+
+def decode_text(raw: bytes) -> str:
+    '''Текст из meta-события: .kar из рунета обычно в cp1251'''
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('cp1251', errors='replace')
+
+def read_track(data: bytes, tempos: list, channels: set) -> tuple:
+    '''События одного трека: возвращает (последний тик, лирика, текстовые события)'''
+    pos = 0
+    tick = 0
+    status = 0
+    lyrics = []
+    texts = []
+    
+    while pos < len(data):
+        delta, pos = read_varlen(data, pos)
+        tick += delta
+        
+        if data[pos] & 0x80:
+            status = data[pos]
+            pos += 1
+        
+        if status == 0xFF:
+            meta_type = data[pos]
+            length, pos = read_varlen(data, pos + 1)
+            payload = data[pos:pos + length]
+            pos += length
+            if meta_type == 0x51 and length == 3:
+                tempos.append((tick, int.from_bytes(payload, 'big')))
+            elif meta_type == 0x05:
+                lyrics.append((tick, decode_text(payload)))
+            elif meta_type == 0x01:
+                texts.append((tick, decode_text(payload)))
+            elif meta_type == 0x2F:
+                break
+        elif status in (0xF0, 0xF7):
+            length, pos = read_varlen(data, pos)
+            pos += length
+        else:
+            channels.add(status & 0x0F)
+            pos += 1 if status & 0xF0 in (0xC0, 0xD0) else 2
+    
+    return tick, lyrics, texts
+
+def ticks_to_seconds(division: int, tempos: list):
+    '''Функция перевода тиков в секунды по карте темпов'''
+    if division & 0x8000:
+        frames = 256 - (division >> 8)
+        ticks_per_second = frames * (division & 0xFF)
+        return lambda tick: tick / ticks_per_second
+    
+    tempo_map = [(0, 0.0, DEFAULT_TEMPO)]
+    for tick, tempo in sorted(tempos):
+        start_tick, start_seconds, current = tempo_map[-1]
+        tempo_map.append((tick, start_seconds + (tick - start_tick) * current / division / 1e6, tempo))
+    
+    def convert(tick: int) -> float:
+        for start_tick, start_seconds, tempo in reversed(tempo_map):
+            if tick >= start_tick:
+                return start_seconds + (tick - start_tick) * tempo / division / 1e6
+        return 0.0
+    
+    return convert
+
+def lyric_lines(events: list, to_seconds) -> list:
+    '''Склеивает слоги в строки с временем начала. В .kar "/" и "\\" начинают новую строку'''
+    lines = []
+    current = None
+    for tick, text in sorted(events, key=lambda e: e[0]):
+        if text.startswith(('/', '\\')) or current is None:
+            current = {'time': round(to_seconds(tick), 2), 'text': ''}
+            lines.append(current)
+            text = text.lstrip('/\\')
+        for i, part in enumerate(text.replace('\r', '\n').split('\n')):
+            if i:
+                current = {'time': round(to_seconds(tick), 2), 'text': ''}
+                lines.append(current)
+            current['text'] += part
+    return [line for line in lines if line['text'].strip()]
+
+def read_smf(stream) -> dict:
+    '''Разбирает Standard MIDI File (.mid/.kar) из потока, держа в памяти по одному треку.
+    Возвращает длительность по карте темпов, стартовый темп, число треков и каналов и текст песни.'''
+    header = stream.read(14)
+    if len(header) < 14:
+        raise ValueError('Not a Standard MIDI File')
+    chunk_type, length, _, track_count, division = struct.unpack('>4sIHHH', header)
+    if chunk_type != b'MThd' or length < 6:
+        raise ValueError('Not a Standard MIDI File')
+    if division == 0 or (division & 0x8000 and division & 0xFF == 0):
+        raise ValueError('Invalid MIDI time division')
+    stream.read(length - 6)
+    
+    tempos = []
+    channels = set()
+    end_tick = 0
+    lyrics = []
+    texts = []
+    
+    for _ in range(track_count):
+        header = stream.read(8)
+        if len(header) < 8:
+            break
+        chunk_type, length = struct.unpack('>4sI', header)
+        data = stream.read(length)
+        if chunk_type != b'MTrk':
+            continue
+        try:
+            last_tick, track_lyrics, track_texts = read_track(data, tempos, channels)
+        except IndexError:
+            raise ValueError('Truncated MIDI track')
+        end_tick = max(end_tick, last_tick)
+        lyrics += track_lyrics
+        texts += track_texts
+    
+    if any(tempo == 0 for _, tempo in tempos):
+        raise ValueError('Invalid MIDI tempo')
+    
+    to_seconds = ticks_to_seconds(division, tempos)
+    # В .kar текст лежит в текстовых событиях, служебные строки начинаются с "@"
+    events = lyrics or [(tick, text) for tick, text in texts if not text.startswith('@')]
+    lines = lyric_lines(events, to_seconds)
+    first_tempo = min(tempos)[1] if tempos else DEFAULT_TEMPO
+    
+    return {
+        'duration': round(to_seconds(end_tick)),
+        'tempo_bpm': round(60e6 / first_tempo, 2),
+        'track_count': track_count,
+        'channel_count': len(channels),
+        'lyrics': '\n'.join(line['text'].strip() for line in lines),
+        'lyric_lines': lines
+    }
@@ -0,0 +1,413 @@
+import functools
+import json
+import os
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import base64
+import hashlib
+import hmac
+import re
+import time
+from contextlib import contextmanager
+
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', '100'))
+SWEEP_MAX_BATCHES = 20
+QUEUE_ARCHIVE_AFTER_MINUTES = int(os.environ.get('QUEUE_ARCHIVE_AFTER_MINUTES', '60'))
+TIMER_EVENT_TYPE = 'yandex.cloud.events.serverless.triggers.TimerMessage'
+
+TRACE_ENABLED = os.environ.get('TRACE_REQUESTS') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAINABLE = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+# Замеры текущего вызова; None — трассировка выключена и все хуки сводятся к одной проверке
+_trace = None
+
+@contextmanager
+def traced(phase: str):
+    '''Добавляет время блока к фазе запроса (connect, query, serialize, s3)'''
+    if _trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, started)
+
+def add_phase(phase: str, started: float) -> None:
+    if _trace is not None:
+        _trace['phases'][phase] = _trace['phases'].get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+class TracedCursor(psycopg2.extensions.cursor):
+    '''Курсор соединений пула: при включённой трассировке считает запросы и строки,
+    медленные запросы пишет в лог вместе с планом'''
+    def execute(self, query, vars=None):
+        if _trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        add_phase('query', started)
+        _trace['queries'] += 1
+        _trace['rows'] += max(self.rowcount, 0)
+        if elapsed >= SLOW_QUERY_MS:
+            _trace['slow'].append({
+                'sql': prepared_text(self.connection, query),
+                'ms': round(elapsed, 1),
+                'plan': explain_statement(self.connection, query, vars)
+            })
+        return result
+
+def prepared_text(conn, query):
+    '''Для EXECUTE stmt_N — исходный текст подготовленного запроса, параметры в лог не попадают'''
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        name = query.split()[1]
+        for sql, (prepared_name, _) in conn.prepared.items():
+            if prepared_name == name:
+                return sql
+    return query
+
+def explain_statement(conn, query: str, vars):
+    '''План медленного запроса без повторного выполнения; в транзакции — под savepoint, чтобы ошибка EXPLAIN её не сломала'''
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(EXPLAINABLE) or ';' in query.rstrip().rstrip(';'):
+        return None
+    savepoint = not conn.autocommit and conn.status != psycopg2.extensions.STATUS_READY
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT trace_explain')
+            cursor.execute('EXPLAIN ' + query, vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT trace_explain')
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return str(e)
+
+def instrumented(function_name: str):
+    '''Обёртка handler: при TRACE_REQUESTS=1 отдаёт фазы в заголовке Server-Timing
+    и пишет одну структурированную строку лога на вызов'''
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            global _trace
+            _trace = {'phases': {}, 'queries': 0, 'rows': 0, 'slow': []}
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                trace, _trace = _trace, None
+            total = (time.perf_counter() - started) * 1000
+            
+            timing = [f'{phase};dur={ms:.1f}' for phase, ms in trace['phases'].items()]
+            timing.append(f'total;dur={total:.1f}')
+            timing.append(f"db;desc=\"{trace['queries']} queries, {trace['rows']} rows\"")
+            response['headers'] = {**response.get('headers', {}), 'Server-Timing': ', '.join(timing), 'Timing-Allow-Origin': '*'}
+            print(json.dumps({
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'status': response['statusCode'],
+                'total_ms': round(total, 1),
+                'phases': {phase: round(ms, 1) for phase, ms in trace['phases'].items()},
+                'queries': trace['queries'],
+                'rows': trace['rows'],
+                'slow_queries': trace['slow'],
+                'error': json.loads(response['body']).get('error') if response['statusCode'] >= 500 else None
+            }, ensure_ascii=False, default=str))
+            return response
+        return wrapper
+    return decorate
+
+def json_response(status: int, payload, headers: dict = None) -> dict:
+    '''Ответ API в JSON с CORS-заголовками'''
+    with traced('serialize'):
+        body = json.dumps(payload)
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **(headers or {})},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def cors_preflight(methods: str, allow_headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS-запрос браузера'''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+SESSION_HEADER = 'X-Session-Token'
+
+def b64url(raw: bytes) -> str:
+    '''base64url без выравнивающих "="'''
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def session_signature(payload: str) -> str:
+    '''HMAC-SHA256 от полезной нагрузки токена на общем секрете функций'''
+    secret = os.environ['SESSION_SECRET'].encode('utf-8')
+    return b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+def read_session(event: dict):
+    '''Claims из заголовка X-Session-Token; None, если токена нет, он не разбирается, подпись не сошлась или срок истёк'''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    payload, _, signature = (headers.get(SESSION_HEADER.lower()) or '').partition('.')
+    # Не-ASCII в токене ломает кодирование и compare_digest: такой токен просто не принимается
+    try:
+        if not payload or not hmac.compare_digest(signature.encode('ascii'), session_signature(payload).encode('ascii')):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('expires_at', 0) <= time.time():
+        return None
+    return claims
+
+def session_denied(session, *roles):
+    '''Ответ 401/403, если сессии нет или её роль не подходит; None — доступ разрешён'''
+    if session is None:
+        return json_response(401, {'error': 'Session token required'})
+    if session['role'] not in roles:
+        return json_response(403, {'error': 'Forbidden'})
+    return None
+
+def timer_event(event: dict) -> bool:
+    '''Вызов от триггера-таймера: у него нет httpMethod, а сообщения помечены типом TimerMessage.
+    Через HTTP такое событие не подделать — шлюз всегда кладёт запрос в httpMethod/body'''
+    messages = event.get('messages') if 'httpMethod' not in event else None
+    return bool(messages) and all(
+        (m.get('event_metadata') or {}).get('event_type') == TIMER_EVENT_TYPE for m in messages
+    )
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_PING_AFTER_SECONDS = 30
+# Потолок подготовленных операторов на соединение: каждый занимает память бэкенда Postgres
+PREPARED_CACHE_SIZE = 64
+
+# Пул соединений инстанса: переживает тёплые вызовы, одно соединение держится открытым
+_db_pool = None
+_db_last_used = {}
+
+SQL_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула с кэшем подготовленных операторов: кэш живёт ровно столько, сколько сессия Postgres'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_total = 0
+        self.cursor_factory = TracedCursor
+
+def execute_prepared(cursor, sql: str, params=()):
+    '''Выполняет запрос через PREPARE/EXECUTE. Разбор и план строятся один раз на соединение,
+    тёплые вызовы функции с тем же соединением из пула только подставляют параметры.
+    Плейсхолдеры как у psycopg2: %s или %(name)s'''
+    conn = cursor.connection
+    statements = conn.prepared
+    if sql in statements:
+        # Порядок словаря — порядок использования: вытесняется самый давно не нужный оператор
+        statements[sql] = statements.pop(sql)
+    else:
+        if len(statements) >= PREPARED_CACHE_SIZE:
+            evicted, _ = statements.pop(next(iter(statements)))
+            cursor.execute(f'DEALLOCATE {evicted}')
+        keys = []
+        
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) else len(keys)
+            if key not in keys:
+                keys.append(key)
+            return f'${keys.index(key) + 1}'
+        
+        # Имя из счётчика соединения, а не из размера кэша: после вытеснения размер повторяется
+        name = f'stmt_{conn.prepared_total}'
+        conn.prepared_total += 1
+        cursor.execute(f'PREPARE {name} AS {SQL_PLACEHOLDER.sub(number, sql)}')
+        statements[sql] = (name, keys)
+    
+    name, keys = statements[sql]
+    values = [params[key] for key in keys]
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}', values)
+
+def get_connection():
+    '''Соединение из пула; простоявшее дольше DB_PING_AFTER_SECONDS проверяется перед выдачей'''
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, DB_POOL_SIZE, os.environ['DATABASE_URL'], connection_factory=PreparedConnection
+        )
+    
+    with traced('connect'):
+        conn = _db_pool.getconn()
+        last_used = _db_last_used.pop(id(conn), None)
+        if conn.closed or (last_used and time.monotonic() - last_used > DB_PING_AFTER_SECONDS and not ping_connection(conn)):
+            _db_pool.putconn(conn, close=True)
+            conn = _db_pool.getconn()
+    return conn
+
+def ping_connection(conn) -> bool:
+    '''Живо ли соединение после простоя'''
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул в чистом состоянии; сломанное закрывается'''
+    try:
+        if not conn.closed:
+            conn.rollback()
+            if conn.autocommit:
+                with conn.cursor() as cursor:
+                    cursor.execute('UNLISTEN *')
+                conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+    _db_last_used[id(conn)] = time.monotonic()
+    _db_pool.putconn(conn, close=bool(conn.closed))
+
+def deactivate_expired_tables(cursor) -> tuple:
+    '''Одна пачка: выключает истёкшие столы (по idx_tables_expires_at) и снимает их ожидающие треки.
+    SKIP LOCKED — параллельный запуск свипера или вход стола не ждут друг друга.
+    Возвращает (выключено столов, снято треков)'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        WITH expired AS (
+            SELECT id FROM {schema}.tables
+            WHERE is_active AND expires_at <= LOCALTIMESTAMP
+            ORDER BY expires_at
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        ), deactivated AS (
+            UPDATE {schema}.tables t SET is_active = false
+            FROM expired
+            WHERE t.id = expired.id
+            RETURNING t.id
+        ), cancelled AS (
+            UPDATE {schema}.queue q SET status = 'cancelled'
+            FROM deactivated
+            WHERE q.table_id = deactivated.id AND q.status = 'pending'
+            RETURNING q.id
+        )
+        SELECT (SELECT COUNT(*) FROM deactivated), (SELECT COUNT(*) FROM cancelled)
+        """,
+        {'batch_size': SWEEP_BATCH_SIZE}
+    )
+    return cursor.fetchone()
+
+def cancel_orphaned_pending(cursor) -> int:
+    '''Одна пачка ожидающих треков столов, выключенных в обход свипера (удаление стола, вход после истечения)'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        WITH orphaned AS (
+            SELECT q.id FROM {schema}.queue q
+            JOIN {schema}.tables t ON t.id = q.table_id
+            WHERE q.status = 'pending' AND NOT t.is_active
+            LIMIT %(batch_size)s
+            FOR UPDATE OF q SKIP LOCKED
+        )
+        UPDATE {schema}.queue q SET status = 'cancelled'
+        FROM orphaned
+        WHERE q.id = orphaned.id
+        """,
+        {'batch_size': SWEEP_BATCH_SIZE}
+    )
+    return cursor.rowcount
+
+def archive_finished_queue(cursor) -> int:
+    '''Одна пачка сыгранных и снятых треков, завершённых дольше QUEUE_ARCHIVE_AFTER_MINUTES назад,
+    переносится в queue_history. Задержка даёт планшетам забрать финальный статус из ленты изменений'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    execute_prepared(
+        cursor,
+        f"""
+        WITH finished AS (
+            SELECT id FROM {schema}.queue
+            WHERE status IN ('played', 'cancelled')
+              AND finished_at < LOCALTIMESTAMP - %(archive_after)s * INTERVAL '1 minute'
+            ORDER BY finished_at
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM {schema}.queue q
+            USING finished
+            WHERE q.id = finished.id
+            RETURNING q.id, q.song_id, q.table_id, q.status, q.added_at, q.played_at, q.finished_at
+        )
+        INSERT INTO {schema}.queue_history (id, song_id, table_id, status, added_at, played_at, finished_at)
+        SELECT * FROM moved
+        ON CONFLICT (id) DO NOTHING
+        """,
+        {'archive_after': QUEUE_ARCHIVE_AFTER_MINUTES, 'batch_size': SWEEP_BATCH_SIZE}
+    )
+    return cursor.rowcount
+
+@instrumented('sweeper')
+def handler(event: dict, context) -> dict:
+    '''Свипер истёкших столов и архиватор очереди: запускается по расписанию (раз в минуту) или вручную.
+    Идемпотентен — повторный запуск без новых истёкших столов и завершённых треков ничего не меняет.'''
+    
+    method = event.get('httpMethod')
+    
+    if method == 'OPTIONS':
+        return cors_preflight('POST, OPTIONS', f'Content-Type, {SESSION_HEADER}')
+    
+    # По расписанию — без сессии; вручную через HTTP — только администратор
+    if not timer_event(event):
+        denied = session_denied(read_session(event), 'admin')
+        if denied:
+            return denied
+    
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        
+        # Каждая пачка — отдельная короткая транзакция, чтобы не держать блокировки на очереди
+        tables_deactivated = 0
+        items_cancelled = 0
+        items_archived = 0
+        for _ in range(SWEEP_MAX_BATCHES):
+            deactivated, cancelled = deactivate_expired_tables(cursor)
+            orphaned = cancel_orphaned_pending(cursor)
+            archived = archive_finished_queue(cursor)
+            conn.commit()
+            tables_deactivated += deactivated
+            items_cancelled += cancelled + orphaned
+            items_archived += archived
+            if max(deactivated, orphaned, archived) < SWEEP_BATCH_SIZE:
+                break
+        
+        return json_response(200, {
+            'success': True,
+            'tables_deactivated': tables_deactivated,
+            'items_cancelled': items_cancelled,
+            'items_archived': items_archived
+        })
+    
+    except Exception as e:
+        return json_response(500, {'error': str(e)})
+    
+    finally:
+        if conn is not None:
+            release_connection(conn)
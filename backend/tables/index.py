@@ -1,105 +1,489 @@
+import functools
 import json
 import os
 import psycopg2
-import bcrypt
+import psycopg2.extensions
+import psycopg2.pool
+import base64
+import gzip
+import hashlib
+import hmac
+import re
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from psycopg2.extras import execute_values
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_BATCH_TABLES = 100
+HASH_CONCURRENCY = 8
+
+COMPRESS_MIN_BYTES = 1024
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+TRACE_ENABLED = os.environ.get('TRACE_REQUESTS') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '100'))
+EXPLAINABLE = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+# Замеры текущего вызова; None — трассировка выключена и все хуки сводятся к одной проверке
+_trace = None
+
+@contextmanager
+def traced(phase: str):
+    '''Добавляет время блока к фазе запроса (connect, query, serialize, s3, bcrypt)'''
+    if _trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, started)
+
+def add_phase(phase: str, started: float) -> None:
+    if _trace is not None:
+        _trace['phases'][phase] = _trace['phases'].get(phase, 0.0) + (time.perf_counter() - started) * 1000
+
+class TracedCursor(psycopg2.extensions.cursor):
+    '''Курсор соединений пула: при включённой трассировке считает запросы и строки,
+    медленные запросы пишет в лог вместе с планом'''
+    def execute(self, query, vars=None):
+        if _trace is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        add_phase('query', started)
+        _trace['queries'] += 1
+        _trace['rows'] += max(self.rowcount, 0)
+        if elapsed >= SLOW_QUERY_MS:
+            _trace['slow'].append({
+                'sql': prepared_text(self.connection, query),
+                'ms': round(elapsed, 1),
+                'plan': explain_statement(self.connection, query, vars)
+            })
+        return result
+
+def prepared_text(conn, query):
+    '''Для EXECUTE stmt_N — исходный текст подготовленного запроса, параметры в лог не попадают'''
+    if isinstance(query, str) and query.startswith('EXECUTE '):
+        name = query.split()[1]
+        for sql, (prepared_name, _) in conn.prepared.items():
+            if prepared_name == name:
+                return sql
+    return query
+
+def explain_statement(conn, query: str, vars):
+    '''План медленного запроса без повторного выполнения; в транзакции — под savepoint, чтобы ошибка EXPLAIN её не сломала'''
+    if not isinstance(query, str) or not query.lstrip().upper().startswith(EXPLAINABLE) or ';' in query.rstrip().rstrip(';'):
+        return None
+    savepoint = not conn.autocommit and conn.status != psycopg2.extensions.STATUS_READY
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT trace_explain')
+            cursor.execute('EXPLAIN ' + query, vars)
+            plan = [row[0] for row in cursor.fetchall()]
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT trace_explain')
+            return plan
+        except psycopg2.Error as e:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT trace_explain')
+            return str(e)
+
+def instrumented(function_name: str):
+    '''Обёртка handler: при TRACE_REQUESTS=1 отдаёт фазы в заголовке Server-Timing
+    и пишет одну структурированную строку лога на вызов'''
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+        
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            global _trace
+            _trace = {'phases': {}, 'queries': 0, 'rows': 0, 'slow': []}
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+            finally:
+                trace, _trace = _trace, None
+            total = (time.perf_counter() - started) * 1000
+            
+            timing = [f'{phase};dur={ms:.1f}' for phase, ms in trace['phases'].items()]
+            timing.append(f'total;dur={total:.1f}')
+            timing.append(f"db;desc=\"{trace['queries']} queries, {trace['rows']} rows\"")
+            response['headers'] = {**response.get('headers', {}), 'Server-Timing': ', '.join(timing), 'Timing-Allow-Origin': '*'}
+            print(json.dumps({
+                'function': function_name,
+                'method': event.get('httpMethod'),
+                'status': response['statusCode'],
+                'total_ms': round(total, 1),
+                'phases': {phase: round(ms, 1) for phase, ms in trace['phases'].items()},
+                'queries': trace['queries'],
+                'rows': trace['rows'],
+                'slow_queries': trace['slow'],
+                'error': json.loads(response['body']).get('error') if response['statusCode'] >= 500 and not response['isBase64Encoded'] else None
+            }, ensure_ascii=False, default=str))
+            return response
+        return wrapper
+    return decorate
+
+def json_default(value):
+    '''Типы из БД, которых нет в JSON: даты в ISO 8601, numeric в число'''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def encode_json(payload) -> bytes:
+    '''JSON в UTF-8 одним вызовом кодировщика: orjson, если установлен, иначе стандартный json'''
+    with traced('serialize'):
+        if orjson is not None:
+            return orjson.dumps(payload, default=json_default)
+        return json.dumps(payload, default=json_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def response_encoding(event, body: bytes):
+    '''Сжатие под Accept-Encoding клиента: br, если доступен brotli, иначе gzip; маленькие тела не сжимаются'''
+    if not event or len(body) < COMPRESS_MIN_BYTES:
+        return None
+    header = next((v for k, v in (event.get('headers') or {}).items() if k.lower() == 'accept-encoding'), '')
+    accepted = set()
+    for part in header.split(','):
+        name, _, weight = part.strip().partition(';')
+        if weight.strip().replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip().lower())
+    if 'br' in accepted and brotli is not None:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+def encoded_body(body: bytes, encoding) -> str:
+    '''Тело ответа шлюзу: UTF-8 как есть или сжатое и в base64'''
+    if encoding is None:
+        return body.decode('utf-8')
+    with traced('compress'):
+        packed = brotli.compress(body, quality=BROTLI_QUALITY) if encoding == 'br' else gzip.compress(body, GZIP_LEVEL, mtime=0)
+    return base64.b64encode(packed).decode('ascii')
+
+def json_response(status: int, payload, headers: dict = None, event: dict = None) -> dict:
+    '''Ответ API в JSON с CORS-заголовками. С event большое тело сжимается под Accept-Encoding клиента'''
+    body = encode_json(payload)
+    encoding = response_encoding(event, body)
+    compression = {'Content-Encoding': encoding} if encoding else {}
+    negotiated = {'Vary': 'Accept-Encoding'} if event else {}
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*', **negotiated, **compression, **(headers or {})},
+        'body': encoded_body(body, encoding),
+        'isBase64Encoded': encoding is not None
+    }
+
+def cors_preflight(methods: str, allow_headers: str = 'Content-Type') -> dict:
+    '''Ответ на OPTIONS-запрос браузера'''
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers
+        },
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+def request_body(event: dict) -> dict:
+    '''JSON-тело запроса; пустое тело — пустой словарь'''
+    return json.loads(event.get('body') or '{}')
+
+def query_params(event: dict) -> dict:
+    '''Параметры строки запроса; шлюз передаёт None, если их нет'''
+    return event.get('queryStringParameters') or {}
+
+SESSION_HEADER = 'X-Session-Token'
+
+def b64url(raw: bytes) -> str:
+    '''base64url без выравнивающих "="'''
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def session_signature(payload: str) -> str:
+    '''HMAC-SHA256 от полезной нагрузки токена на общем секрете функций'''
+    secret = os.environ['SESSION_SECRET'].encode('utf-8')
+    return b64url(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+
+def read_session(event: dict):
+    '''Claims из заголовка X-Session-Token; None, если токена нет, он не разбирается, подпись не сошлась или срок истёк'''
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    payload, _, signature = (headers.get(SESSION_HEADER.lower()) or '').partition('.')
+    # Не-ASCII в токене ломает кодирование и compare_digest: такой токен просто не принимается
+    try:
+        if not payload or not hmac.compare_digest(signature.encode('ascii'), session_signature(payload).encode('ascii')):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if claims.get('expires_at', 0) <= time.time():
+        return None
+    return claims
+
+def session_denied(session, *roles):
+    '''Ответ 401/403, если сессии нет или её роль не подходит; None — доступ разрешён'''
+    if session is None:
+        return json_response(401, {'error': 'Session token required'})
+    if session['role'] not in roles:
+        return json_response(403, {'error': 'Forbidden'})
+    return None
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '2'))
+DB_PING_AFTER_SECONDS = 30
+# Потолок подготовленных операторов на соединение: каждый занимает память бэкенда Postgres
+PREPARED_CACHE_SIZE = 64
+
+# Пул соединений инстанса: переживает тёплые вызовы, одно соединение держится открытым
+_db_pool = None
+_db_last_used = {}
+
+SQL_PLACEHOLDER = re.compile(r'%\((\w+)\)s|%s|%%')
+
+class PreparedConnection(psycopg2.extensions.connection):
+    '''Соединение пула с кэшем подготовленных операторов: кэш живёт ровно столько, сколько сессия Postgres'''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+        self.prepared_total = 0
+        self.cursor_factory = TracedCursor
+
+def execute_prepared(cursor, sql: str, params=()):
+    '''Выполняет запрос через PREPARE/EXECUTE. Разбор и план строятся один раз на соединение,
+    тёплые вызовы функции с тем же соединением из пула только подставляют параметры.
+    Плейсхолдеры как у psycopg2: %s или %(name)s'''
+    conn = cursor.connection
+    statements = conn.prepared
+    if sql in statements:
+        # Порядок словаря — порядок использования: вытесняется самый давно не нужный оператор
+        statements[sql] = statements.pop(sql)
+    else:
+        if len(statements) >= PREPARED_CACHE_SIZE:
+            evicted, _ = statements.pop(next(iter(statements)))
+            cursor.execute(f'DEALLOCATE {evicted}')
+        keys = []
+        
+        def number(match):
+            if match.group(0) == '%%':
+                return '%'
+            key = match.group(1) if match.group(1) else len(keys)
+            if key not in keys:
+                keys.append(key)
+            return f'${keys.index(key) + 1}'
+        
+        # Имя из счётчика соединения, а не из размера кэша: после вытеснения размер повторяется
+        name = f'stmt_{conn.prepared_total}'
+        conn.prepared_total += 1
+        cursor.execute(f'PREPARE {name} AS {SQL_PLACEHOLDER.sub(number, sql)}')
+        statements[sql] = (name, keys)
+    
+    name, keys = statements[sql]
+    values = [params[key] for key in keys]
+    cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(values))})" if values else f'EXECUTE {name}', values)
+
+def get_connection():
+    '''Соединение из пула; простоявшее дольше DB_PING_AFTER_SECONDS проверяется перед выдачей'''
+    global _db_pool
+    if _db_pool is None:
+        _db_pool = psycopg2.pool.SimpleConnectionPool(
+            1, DB_POOL_SIZE, os.environ['DATABASE_URL'], connection_factory=PreparedConnection
+        )
+    
+    with traced('connect'):
+        conn = _db_pool.getconn()
+        last_used = _db_last_used.pop(id(conn), None)
+        if conn.closed or (last_used and time.monotonic() - last_used > DB_PING_AFTER_SECONDS and not ping_connection(conn)):
+            _db_pool.putconn(conn, close=True)
+            conn = _db_pool.getconn()
+    return conn
+
+def ping_connection(conn) -> bool:
+    '''Живо ли соединение после простоя'''
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def release_connection(conn) -> None:
+    '''Возвращает соединение в пул в чистом состоянии; сломанное закрывается'''
+    try:
+        if not conn.closed:
+            conn.rollback()
+            if conn.autocommit:
+                with conn.cursor() as cursor:
+                    cursor.execute('UNLISTEN *')
+                conn.autocommit = False
+    except psycopg2.Error:
+        conn.close()
+    _db_last_used[id(conn)] = time.monotonic()
+    _db_pool.putconn(conn, close=bool(conn.closed))
+
+def bcrypt_hash(password: str) -> str:
+    '''bcrypt-хэш пароля без замера; bcrypt загружается при первом обращении, а не при холодном старте'''
+    import bcrypt
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+
+def hash_password(password: str) -> str:
+    '''bcrypt-хэш пароля, время идёт в фазу bcrypt'''
+    with traced('bcrypt'):
+        return bcrypt_hash(password)
+
+def hash_passwords(passwords: list) -> list:
+    '''bcrypt-хэши пачки паролей параллельно: bcrypt отпускает GIL, поэтому потоки занимают все ядра инстанса.
+    В фазу bcrypt идёт время всей пачки, а не сумма потоков, иначе она превысила бы total'''
+    workers = max(1, min(len(passwords), HASH_CONCURRENCY, os.cpu_count() or 1))
+    with traced('bcrypt'):
+        if workers == 1:
+            return [bcrypt_hash(password) for password in passwords]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(bcrypt_hash, passwords))
+
+def create_tables(cursor, tables: list, hours, admin_id) -> tuple:
+    '''Создаёт пачку столов одним INSERT. Возвращает (созданные столы, занятые номера и логины);
+    если что-то занято, ничего не вставляется'''
+    schema = os.environ['MAIN_DB_SCHEMA']
+    numbers = [t['table_number'] for t in tables]
+    logins = [t['login'] for t in tables]
+    execute_prepared(
+        cursor,
+        f"SELECT table_number, login FROM {schema}.tables WHERE table_number = ANY(%s) OR login = ANY(%s)",
+        (numbers, logins)
+    )
+    taken = [{'table_number': row[0], 'login': row[1]} for row in cursor]
+    if taken:
+        return [], taken
+    
+    expires_at = datetime.now() + timedelta(hours=hours)
+    hashes = hash_passwords([t['password'] for t in tables])
+    created = execute_values(
+        cursor,
+        f"""
+        INSERT INTO {schema}.tables (table_number, login, password_hash, expires_at, created_by)
+        VALUES %s
+        RETURNING id, table_number, login, expires_at, is_active
+        """,
+        [(t['table_number'], t['login'], hashed, expires_at, admin_id) for t, hashed in zip(tables, hashes)],
+        page_size=MAX_BATCH_TABLES,
+        fetch=True
+    )
+    columns = ('id', 'table_number', 'login', 'expires_at', 'is_active')
+    return sorted((dict(zip(columns, row)) for row in created), key=lambda t: t['table_number']), []
+
+@instrumented('tables')
 def handler(event: dict, context) -> dict:
     '''API для управления столами караоке-бара (создание, удаление, список)'''
     
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return cors_preflight('GET, POST, PUT, DELETE, OPTIONS', f'Content-Type, {SESSION_HEADER}')
     
+    # Список с логинами и изменение столов — только администратору; токен проверяется до подключения к БД
+    session = read_session(event)
+    denied = session_denied(session, 'admin')
+    if denied:
+        return denied
+    
+    conn = None
     try:
-        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        conn = get_connection()
         cursor = conn.cursor()
         
         if method == 'GET':
-            cursor.execute(
+            execute_prepared(
+                cursor,
                 f"SELECT id, table_number, login, expires_at, is_active, created_at FROM {os.environ['MAIN_DB_SCHEMA']}.tables ORDER BY table_number"
             )
-            tables = cursor.fetchall()
-            
-            result = []
-            for table in tables:
-                result.append({
-                    'id': table[0],
-                    'table_number': table[1],
-                    'login': table[2],
-                    'expires_at': table[3].isoformat(),
-                    'is_active': table[4],
-                    'created_at': table[5].isoformat()
-                })
+            columns = ('id', 'table_number', 'login', 'expires_at', 'is_active', 'created_at')
+            result = [dict(zip(columns, table)) for table in cursor]
             
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'tables': result}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'tables': result}, event=event)
         
         elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
+            body = request_body(event)
+            
+            if body.get('action') == 'batch':
+                tables = body.get('tables')
+                if not isinstance(tables, list) or not 0 < len(tables) <= MAX_BATCH_TABLES:
+                    return json_response(400, {'error': f'tables must be a list of 1 to {MAX_BATCH_TABLES} tables'})
+                try:
+                    tables = [{'table_number': int(t['table_number']), 'login': t['login'], 'password': t['password']} for t in tables]
+                    hours = float(body.get('hours', 2))
+                except (KeyError, TypeError, ValueError):
+                    return json_response(400, {'error': 'Every table needs table_number, login and password'})
+                if not all(t['login'] and t['password'] for t in tables):
+                    return json_response(400, {'error': 'Every table needs table_number, login and password'})
+                if len({t['table_number'] for t in tables}) < len(tables) or len({t['login'] for t in tables}) < len(tables):
+                    return json_response(400, {'error': 'Table numbers and logins must be unique within the batch'})
+                
+                created, taken = create_tables(cursor, tables, hours, session['id'])
+                if taken:
+                    conn.rollback()
+                    return json_response(409, {'error': 'Table number or login already exists', 'taken': taken})
+                conn.commit()
+                
+                return json_response(201, {'success': True, 'tables': created})
+            
             table_number = body.get('table_number')
             login = body.get('login')
             password = body.get('password')
             hours = body.get('hours', 2)
-            admin_id = body.get('admin_id', 1)
+            # Автор стола — из проверенной сессии, а не из тела запроса
+            admin_id = session['id']
             
             if not table_number or not login or not password:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Table number, login and password required'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(400, {'error': 'Table number, login and password required'})
             
-            hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+            hashed = hash_password(password)
             expires_at = datetime.now() + timedelta(hours=hours)
             
-            cursor.execute(
+            execute_prepared(
+                cursor,
                 f"""
                 INSERT INTO {os.environ['MAIN_DB_SCHEMA']}.tables 
                 (table_number, login, password_hash, expires_at, created_by) 
-                VALUES ({table_number}, '{login}', '{hashed}', '{expires_at.isoformat()}', {admin_id})
+                VALUES (%s, %s, %s, %s, %s)
                 RETURNING id, table_number, login, expires_at, is_active
-                """
+                """,
+                (table_number, login, hashed, expires_at, admin_id)
             )
             new_table = cursor.fetchone()
             conn.commit()
-            conn.close()
             
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'table': {
-                        'id': new_table[0],
-                        'table_number': new_table[1],
-                        'login': new_table[2],
-                        'expires_at': new_table[3].isoformat(),
-                        'is_active': new_table[4]
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            return json_response(201, {
+                'success': True,
+                'table': {
+                    'id': new_table[0],
+                    'table_number': new_table[1],
+                    'login': new_table[2],
+                    'expires_at': new_table[3].isoformat(),
+                    'is_active': new_table[4]
+                }
+            })
         
         elif method == 'PUT':
-            body = json.loads(event.get('body', '{}'))
+            body = request_body(event)
             table_id = body.get('id')
             table_number = body.get('table_number')
             login = body.get('login')
@@ -107,97 +491,65 @@ def handler(event: dict, context) -> dict:
             hours = body.get('hours')
             
             if not table_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Table ID required'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(400, {'error': 'Table ID required'})
             
             updates = []
+            values = []
             if table_number:
-                updates.append(f"table_number = {table_number}")
+                updates.append("table_number = %s")
+                values.append(table_number)
             if login:
-                updates.append(f"login = '{login}'")
+                updates.append("login = %s")
+                values.append(login)
             if password:
-                hashed = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
-                updates.append(f"password_hash = '{hashed}'")
+                updates.append("password_hash = %s")
+                values.append(hash_password(password))
             if hours:
-                expires_at = datetime.now() + timedelta(hours=int(hours))
-                updates.append(f"expires_at = '{expires_at.isoformat()}'")
+                updates.append("expires_at = %s")
+                values.append(datetime.now() + timedelta(hours=int(hours)))
                 updates.append("is_active = true")
             
             if updates:
-                query = f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET {', '.join(updates)} WHERE id = {table_id} RETURNING id, table_number, login, expires_at, is_active"
-                cursor.execute(query)
+                query = f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET {', '.join(updates)} WHERE id = %s RETURNING id, table_number, login, expires_at, is_active"
+                execute_prepared(cursor, query, values + [table_id])
                 updated = cursor.fetchone()
                 conn.commit()
-                conn.close()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'success': True,
-                        'table': {
-                            'id': updated[0],
-                            'table_number': updated[1],
-                            'login': updated[2],
-                            'expires_at': updated[3].isoformat(),
-                            'is_active': updated[4]
-                        }
-                    }),
-                    'isBase64Encoded': False
-                }
+                return json_response(200, {
+                    'success': True,
+                    'table': {
+                        'id': updated[0],
+                        'table_number': updated[1],
+                        'login': updated[2],
+                        'expires_at': updated[3].isoformat(),
+                        'is_active': updated[4]
+                    }
+                })
             
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'No fields to update'}),
-                'isBase64Encoded': False
-            }
+            return json_response(400, {'error': 'No fields to update'})
         
         elif method == 'DELETE':
-            params = event.get('queryStringParameters', {})
+            params = query_params(event)
             table_id = params.get('id')
             
             if not table_id:
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Table ID required'}),
-                    'isBase64Encoded': False
-                }
+                return json_response(400, {'error': 'Table ID required'})
             
-            cursor.execute(
-                f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET is_active = false WHERE id = {table_id}"
+            execute_prepared(
+                cursor,
+                f"UPDATE {os.environ['MAIN_DB_SCHEMA']}.tables SET is_active = false WHERE id = %s",
+                (table_id,)
             )
             conn.commit()
-            conn.close()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'success': True})
         
         else:
-            conn.close()
-            return {
-                'statusCode': 405,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Method not allowed'}),
-                'isBase64Encoded': False
-            }
+            return json_response(405, {'error': 'Method not allowed'})
     
     except Exception as e:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
\ No newline at end of file
+        return json_response(500, {'error': str(e)})
+    
+    finally:
+        if conn is not None:
+            release_connection(conn)
@@ -0,0 +1,65 @@
+'''Синтетические данные бара для бенчмарков: схема из db_migrations и заполнение'''
+import glob
+import os
+from handlers import BACKEND
+
+SONGS = 50000
+TABLES = 200
+HISTORY = 200000
+PENDING = 400
+PASSWORD = 'bench'
+
+def migrate(cursor, schema: str) -> None:
+    '''Схема schema с нуля из миграций по порядку версий'''
+    cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {schema}')
+    cursor.execute(f'SET search_path = {schema}, public')
+    migrations = glob.glob(os.path.join(BACKEND, '..', 'db_migrations', 'V*__*.sql'))
+    for path in sorted(migrations, key=lambda p: int(os.path.basename(p)[1:].split('__')[0])):
+        with open(path, encoding='utf-8') as f:
+            cursor.execute(f.read())
+
+def seed(cursor, password_hash: str) -> None:
+    '''Синтетическая библиотека, столы и очередь: длинная история и небольшое горячее множество'''
+    cursor.execute(
+        """
+        INSERT INTO songs (title, artist, genre, file_url, file_format, duration, content_hash, track_count)
+        SELECT 'Песня ' || g, 'Исполнитель ' || (g %% 5000),
+               (ARRAY['Поп', 'Рок', 'Шансон', 'Эстрада', 'Без жанра'])[1 + g %% 5],
+               'https://cdn.example/' || g || '.kar', 'kar', 120 + g %% 240,
+               md5(g::text) || md5((-g)::text), 16
+        FROM generate_series(1, %(songs)s) g
+        """,
+        {'songs': SONGS}
+    )
+    cursor.execute(
+        "INSERT INTO song_lyrics (song_id, lyrics) SELECT id, 'куплет ' || id || ' группа крови на рукаве' FROM songs WHERE id % 5 = 0"
+    )
+    cursor.execute(
+        """
+        INSERT INTO tables (table_number, login, password_hash, expires_at)
+        SELECT g, 'table' || g, %(hash)s, LOCALTIMESTAMP + INTERVAL '2 hours'
+        FROM generate_series(1, %(tables)s) g
+        """,
+        {'hash': password_hash, 'tables': TABLES}
+    )
+    cursor.execute("UPDATE users SET password_hash = %s", (password_hash,))
+    # Историю вставляем без ревизий при коммите: строки получают ревизии 1..N по порядку вставки
+    cursor.execute('ALTER TABLE queue DISABLE TRIGGER queue_commit_revision')
+    cursor.execute(
+        """
+        INSERT INTO queue (song_id, table_id, status, added_at, played_at, sched_round)
+        SELECT 1 + g %% %(songs)s, 1 + g %% %(tables)s,
+               CASE WHEN g > %(history)s THEN 'pending' WHEN g %% 7 = 0 THEN 'cancelled' ELSE 'played' END,
+               LOCALTIMESTAMP - (%(total)s - g) * INTERVAL '30 seconds',
+               CASE WHEN g <= %(history)s THEN LOCALTIMESTAMP - (%(total)s - g) * INTERVAL '30 seconds' END,
+               g
+        FROM generate_series(1, %(total)s) g
+        """,
+        {'songs': SONGS, 'tables': TABLES, 'history': HISTORY, 'total': HISTORY + PENDING}
+    )
+    cursor.execute(
+        "UPDATE queue SET status = 'playing', played_at = LOCALTIMESTAMP WHERE id = (SELECT MIN(id) FROM queue WHERE status = 'pending')"
+    )
+    cursor.execute('ALTER TABLE queue ENABLE TRIGGER queue_commit_revision')
+    cursor.execute('ANALYZE')
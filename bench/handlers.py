@@ -0,0 +1,14 @@
+'''Загрузка обработчиков облачных функций в процесс бенчмарка'''
+import importlib.util
+import os
+import sys
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+def load_handler(name: str):
+    '''index.py функции как отдельный модуль, как его загружает рантайм'''
+    sys.path.insert(0, os.path.join(BACKEND, name))
+    spec = importlib.util.spec_from_file_location(f'{name}_index', os.path.join(BACKEND, name, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,326 @@
+'''Нагрузочный бенчмарк обработчиков: пятничный вечер в процессе.
+
+Поднимает синтетический бар во временной схеме локального Postgres (см. dataset.py),
+прогоняет все запросы из backend/*/tests.json как проверку, затем гоняет смесь трафика
+(планшеты опрашивают очередь, поиск, заказы, входы столов) через handler(event, context)
+четырёх функций. Каждый поток — отдельный «инстанс» со своими копиями модулей и пулом.
+S3 заменён заглушкой в памяти. Отчёт: req/s, p50/p95/p99 и число запросов к БД на вызов
+по каждой операции, плюс время холодного импорта каждой функции.
+С --compare-pool смесь прогоняется ещё раз без пула (новое соединение на каждый вызов,
+как до пула) и печатается сравнение p50/p99 по операциям.
+
+Результаты сравниваются с bench/baselines.json; при регрессии больше допуска — код выхода 1.
+Базовая линия в репозитории не хранится: она зависит от машины и Postgres, на которых гоняется
+бенчмарк. Пока её не записали через --save-baseline на этой машине, проверка регрессий не работает,
+и прогон только печатает отчёт (проверка статусов из tests.json действует всегда).
+    
+    DATABASE_URL=postgresql://localhost/karaoke python bench/load.py --requests 5000 --instances 8
+    DATABASE_URL=... python bench/load.py --save-baseline
+    DATABASE_URL=... python bench/load.py --compare-pool
+'''
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+import psycopg2
+from dataset import PASSWORD, SONGS, TABLES, migrate, seed
+from handlers import BACKEND, load_handler
+
+SCHEMA = 'bench_load'
+FUNCTIONS = ('auth', 'songs', 'tables', 'queue', 'sweeper')
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+# Допуск к базовой линии: задержки и req/s на шумной машине гуляют. Среднее число запросов к БД
+# тоже не постоянно: снимок каталога и проверка его версии раз в CATALOG_TTL_SECONDS зависят от того,
+# как запросы легли по инстансам и по времени, проверка соединения после простоя добавляет SELECT 1.
+# Лишний запрос на каждый вызов сдвигает среднее на целую единицу, поэтому допуск — ползапроса
+LATENCY_TOLERANCE = 0.25
+THROUGHPUT_TOLERANCE = 0.2
+QUERIES_TOLERANCE = 0.5
+SEARCH_TERMS = ('kino', 'ispolnitel 12', 'песня 100', 'pesnya', 'исполнитель 4')
+
+_counter = threading.local()
+
+class CountingCursor:
+    '''Примесь к курсору функции, считающая обращения к БД; PREPARE и DEALLOCATE не считаются — это обслуживание кэша операторов'''
+    def execute(self, query, vars=None):
+        if not (isinstance(query, str) and query.startswith(('PREPARE ', 'DEALLOCATE '))):
+            _counter.queries = getattr(_counter, 'queries', 0) + 1
+        return super().execute(query, vars)
+
+class MemoryS3:
+    '''Заглушка S3 для загрузок: объекты в памяти, presigned URL — фиктивные'''
+    class exceptions:
+        class ClientError(Exception):
+            pass
+    
+    def __init__(self):
+        self.objects = {}
+    
+    def head_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise self.exceptions.ClientError(Key)
+        return {'ContentLength': len(self.objects[Key])}
+    
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+    
+    def generate_presigned_url(self, operation, Params, ExpiresIn):
+        return f"https://s3.local/{Params['Key']}"
+
+def without_pool(module) -> None:
+    '''Прежний путь без пула: psycopg2.connect на каждый вызов и закрытие после него'''
+    def get_connection():
+        with module.traced('connect'):
+            return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=module.PreparedConnection)
+    
+    module.get_connection = get_connection
+    module.release_connection = lambda conn: conn.close()
+
+def load_instance(pooled: bool = True) -> dict:
+    '''Один тёплый инстанс: свои копии модулей функций, пул соединений и снимок каталога'''
+    modules = {name: load_handler(name) for name in FUNCTIONS}
+    for module in modules.values():
+        module.TracedCursor = type('CountingCursor', (CountingCursor, module.TracedCursor), {})
+        if not pooled:
+            without_pool(module)
+    modules['songs']._s3 = MemoryS3()
+    return modules
+
+def test_events() -> list:
+    '''Запросы из tests.json всех функций: (функция, событие, ожидаемый статус)'''
+    events = []
+    for name in FUNCTIONS:
+        path = os.path.join(BACKEND, name, 'tests.json')
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            for test in json.load(f)['tests']:
+                url = urlsplit(test['path'])
+                events.append((name, {
+                    'httpMethod': test['method'],
+                    'queryStringParameters': dict(parse_qsl(url.query)) or None,
+                    'headers': {},
+                    'body': json.dumps(test['body']) if 'body' in test else None
+                }, test['expectedStatus']))
+    return events
+
+def prepare_fixtures(cursor, events: list, tables) -> None:
+    '''Пароли администраторов из успешных входов в tests.json, чтобы эти проверки проходили на синтетике'''
+    for function, event, expected in events:
+        body = json.loads(event['body'] or '{}')
+        if function == 'auth' and body.get('action') == 'admin_login' and expected == 200:
+            cursor.execute(
+                'UPDATE users SET password_hash = %s WHERE username = %s',
+                (tables.hash_password(body['password']), body['username'])
+            )
+
+def traffic_mix(auth) -> list:
+    '''Смесь вечернего трафика: (вес, операция, функция, фабрика события)'''
+    sessions = {t: {'X-Session-Token': auth.issue_session('table', t)['token']} for t in range(1, TABLES + 1)}
+    
+    def table_poll():
+        table_id = random.randint(1, TABLES)
+        return {'httpMethod': 'GET', 'queryStringParameters': {'status': 'pending', 'table_id': str(table_id)}}
+    
+    def feed_poll():
+        return {'httpMethod': 'GET', 'queryStringParameters': {'since': '0' if random.random() < 0.05 else str(2 ** 31)}}
+    
+    def search():
+        return {'httpMethod': 'GET', 'queryStringParameters': {'search': random.choice(SEARCH_TERMS)}}
+    
+    def lyrics():
+        return {'httpMethod': 'GET', 'queryStringParameters': {'lyrics': 'группа крови'}}
+    
+    def catalog_page():
+        return {'httpMethod': 'GET', 'queryStringParameters': {'limit': '100', 'fields': 'id,title,artist,genre'}}
+    
+    last_keys = {}
+    
+    def enqueue():
+        table_id = random.randint(1, TABLES)
+        body = {'song_id': random.randint(1, SONGS), 'table_id': table_id}
+        # Каждый пятый запрос — повтор ненадёжного планшета с прежним ключом идемпотентности
+        if table_id not in last_keys or random.random() >= 0.2:
+            last_keys[table_id] = f'{table_id}-{random.getrandbits(64):x}'
+        headers = {**sessions[table_id], 'Idempotency-Key': last_keys[table_id]}
+        return {'httpMethod': 'POST', 'headers': headers, 'body': json.dumps(body)}
+    
+    def table_login():
+        body = {'action': 'table_login', 'username': f'table{random.randint(1, TABLES)}', 'password': PASSWORD}
+        return {'httpMethod': 'POST', 'body': json.dumps(body)}
+    
+    return [
+        (30, 'queue table poll', 'queue', table_poll),
+        (20, 'queue feed poll', 'queue', feed_poll),
+        (20, 'songs search', 'songs', search),
+        (5, 'songs lyrics', 'songs', lyrics),
+        (10, 'songs page', 'songs', catalog_page),
+        (10, 'queue enqueue', 'queue', enqueue),
+        (5, 'table login', 'auth', table_login)
+    ]
+
+def percentile(values: list, q: float) -> float:
+    '''Перцентиль q (0..1) без интерполяции'''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def cold_start(runs: int = 5) -> dict:
+    '''Медиана времени импорта index.py каждой функции в свежем интерпретаторе, мс'''
+    script = (
+        'import sys, time; sys.path.insert(0, sys.argv[1]); sys.path.insert(0, sys.argv[2]);'
+        'started = time.perf_counter(); from handlers import load_handler; load_handler(sys.argv[3]);'
+        'print((time.perf_counter() - started) * 1000)'
+    )
+    bench_dir = os.path.dirname(os.path.abspath(__file__))
+    result = {}
+    for name in FUNCTIONS:
+        timings = [
+            float(subprocess.run(
+                [sys.executable, '-c', script, bench_dir, os.path.join(BACKEND, name), name],
+                capture_output=True, text=True, check=True
+            ).stdout)
+            for _ in range(runs)
+        ]
+        result[name] = statistics.median(timings)
+    return result
+
+def run(requests: int, instances: int, pooled: bool = True) -> dict:
+    '''Прогон смеси: метрики по операциям'''
+    instance_modules = [load_instance(pooled) for _ in range(instances)]
+    mix = traffic_mix(instance_modules[0]['auth'])
+    weights = [weight for weight, *_ in mix]
+    samples = {label: {'timings': [], 'queries': [], 'errors': 0} for _, label, _, _ in mix}
+    lock = threading.Lock()
+    
+    def worker(modules: dict, count: int) -> None:
+        for _ in range(count):
+            _, label, function, make_event = random.choices(mix, weights)[0]
+            _counter.queries = 0
+            started = time.perf_counter()
+            response = modules[function].handler(make_event(), None)
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                sample = samples[label]
+                sample['timings'].append(elapsed)
+                sample['queries'].append(_counter.queries)
+                if response['statusCode'] >= 500:
+                    sample['errors'] += 1
+    
+    started = time.perf_counter()
+    with ThreadPoolExecutor(instances) as pool:
+        futures = [pool.submit(worker, modules, requests // instances) for modules in instance_modules]
+        for future in futures:
+            future.result()
+    wall = time.perf_counter() - started
+    
+    report = {'total': {'rps': round(sum(len(s['timings']) for s in samples.values()) / wall, 1)}}
+    for label, sample in samples.items():
+        timings = sample['timings']
+        if not timings:
+            continue
+        report[label] = {
+            'count': len(timings),
+            'rps': round(len(timings) / wall, 1),
+            'p50': round(percentile(timings, 0.5), 2),
+            'p95': round(percentile(timings, 0.95), 2),
+            'p99': round(percentile(timings, 0.99), 2),
+            'queries': round(statistics.mean(sample['queries']), 2),
+            'errors': sample['errors']
+        }
+    return report
+
+def regressions(report: dict, baseline: dict) -> list:
+    '''Отклонения от базовой линии сверх допуска'''
+    failures = []
+    for label, base in baseline.items():
+        current = report.get(label)
+        if current is None:
+            continue
+        if 'p95' in base and current['p95'] > base['p95'] * (1 + LATENCY_TOLERANCE):
+            failures.append(f"{label}: p95 {current['p95']} ms > baseline {base['p95']} ms")
+        if 'rps' in base and current['rps'] < base['rps'] * (1 - THROUGHPUT_TOLERANCE):
+            failures.append(f"{label}: {current['rps']} req/s < baseline {base['rps']} req/s")
+        if 'queries' in base and current['queries'] > base['queries'] + QUERIES_TOLERANCE:
+            failures.append(f"{label}: {current['queries']} DB queries per request > baseline {base['queries']}")
+        if 'import_ms' in base and current['import_ms'] > base['import_ms'] * (1 + LATENCY_TOLERANCE):
+            failures.append(f"{label}: import {current['import_ms']} ms > baseline {base['import_ms']} ms")
+        if current.get('errors'):
+            failures.append(f"{label}: {current['errors']} responses with status 5xx")
+    return failures
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--compare-pool', action='store_true', help='повторить смесь без пула и сравнить p50/p99')
+    parser.add_argument('--keep', action='store_true', help='не удалять схему с данными после прогона')
+    args = parser.parse_args()
+    
+    os.environ['MAIN_DB_SCHEMA'] = SCHEMA
+    os.environ.setdefault('SESSION_SECRET', 'bench')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn.autocommit = True
+    cursor = conn.cursor()
+    migrate(cursor, SCHEMA)
+    tables = load_handler('tables')
+    seed(cursor, tables.hash_password(PASSWORD))
+    events = test_events()
+    prepare_fixtures(cursor, events, tables)
+    
+    failures = []
+    instance = load_instance()
+    for function, event, expected in events:
+        status = instance[function].handler(event, None)['statusCode']
+        if status != expected:
+            failures.append(f"tests.json {function} {event['httpMethod']}: status {status}, expected {expected}")
+    
+    report = run(args.requests, args.instances)
+    for name, import_ms in cold_start().items():
+        report[f'cold start {name}'] = {'import_ms': round(import_ms, 1)}
+    
+    print(f"{'operation':<24}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'queries':>9}")
+    for label, row in report.items():
+        if 'import_ms' in row:
+            print(f"{label:<24}{'':>9}{row['import_ms']:>9}")
+        else:
+            print(f"{label:<24}{row['rps']:>9}{row.get('p50', ''):>9}{row.get('p95', ''):>9}{row.get('p99', ''):>9}{row.get('queries', ''):>9}")
+    
+    if args.compare_pool:
+        unpooled = run(args.requests, args.instances, pooled=False)
+        print(f"{'operation':<24}{'p50 pool':>10}{'p50 none':>10}{'p99 pool':>10}{'p99 none':>10}")
+        for label, row in unpooled.items():
+            if 'p50' in row and label in report:
+                pooled = report[label]
+                print(f"{label:<24}{pooled['p50']:>10}{row['p50']:>10}{pooled['p99']:>10}{row['p99']:>10}")
+        print(f"{'total req/s':<24}{report['total']['rps']:>10}{unpooled['total']['rps']:>10}")
+    
+    if args.save_baseline:
+        with open(BASELINES, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(report, ensure_ascii=False, indent=2) + '\n')
+    elif os.path.exists(BASELINES):
+        with open(BASELINES, encoding='utf-8') as f:
+            failures += regressions(report, json.load(f))
+    else:
+        print('No baseline yet, regression gate is inactive: run with --save-baseline to record one')
+    
+    if not args.keep:
+        cursor.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+    conn.close()
+    
+    for failure in failures:
+        print('FAIL', failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+'''Микробенчмарк PREPARE/EXECUTE на горячих запросах очереди и каталога.
+
+Гоняет GET-обработчики queue и songs в процессе против локального Postgres
+дважды: с кэшем подготовленных операторов и с обычным cursor.execute,
+и печатает среднее и p95 по каждому запросу.
+
+    DATABASE_URL=postgresql://localhost/karaoke MAIN_DB_SCHEMA=public \\
+    SESSION_SECRET=bench AWS_ACCESS_KEY_ID=bench python bench/prepared_statements.py 500
+'''
+import statistics
+import sys
+import time
+from handlers import load_handler
+
+def plain_execute(cursor, sql: str, params=()):
+    '''То же, что execute_prepared, но с разбором и планированием на каждый вызов'''
+    cursor.execute(sql, params)
+
+def measure(call, iterations: int) -> list:
+    '''Время каждого из iterations вызовов в миллисекундах'''
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = call()
+        timings.append((time.perf_counter() - started) * 1000)
+        if response['statusCode'] >= 400:
+            raise RuntimeError(response['body'])
+    return timings
+
+def main(iterations: int) -> None:
+    queue = load_handler('queue')
+    songs = load_handler('songs')
+    
+    def catalog(params: dict):
+        def call():
+            # Снимок каталога сбрасывается, чтобы каждый вызов доходил до БД
+            songs._catalog_cache.update(version=None, checked_at=0.0, pages={})
+            return songs.handler({'httpMethod': 'GET', 'queryStringParameters': params}, None)
+        return call
+    
+    cases = {
+        'queue pending': lambda: queue.handler({'httpMethod': 'GET', 'queryStringParameters': {'status': 'pending'}}, None),
+        'queue changes': lambda: queue.handler({'httpMethod': 'GET', 'queryStringParameters': {'since': '0'}}, None),
+        'songs page': catalog({'limit': '100'}),
+        'songs search': catalog({'search': 'kino'})
+    }
+    
+    prepared = {module: module.execute_prepared for module in (queue, songs)}
+    print(f"{'query':<16}{'mode':<10}{'mean ms':>10}{'p95 ms':>10}")
+    for label, call in cases.items():
+        for mode in ('execute', 'prepared'):
+            for module, execute in prepared.items():
+                module.execute_prepared = plain_execute if mode == 'execute' else execute
+            call()
+            timings = measure(call, iterations)
+            p95 = statistics.quantiles(timings, n=20)[-1]
+            print(f'{label:<16}{mode:<10}{statistics.mean(timings):>10.2f}{p95:>10.2f}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,165 @@
+'''Регрессия планов запросов обработчиков на синтетических данных.
+
+Создаёт во временной схеме локального Postgres все таблицы из db_migrations,
+заполняет их (по умолчанию 50 000 треков, 200 столов, 200 000 строк истории очереди),
+вызывает обработчики в процессе и делает EXPLAIN ANALYZE каждого их запроса в том виде,
+в каком он ушёл в Postgres: подготовленные — как EXECUTE stmt_N (...) на том же соединении
+(план подготовленного оператора, а не запроса с литералами), остальные — как cursor.execute
+(добавление трека, переключение, пачки очереди, свипер). Записи повторяются на состоянии
+после вызова и откатываются.
+Падает, если на больших таблицах появился Seq Scan, если ожидаемый индекс не используется
+или если запросы случая не уложились в бюджет по времени.
+    
+    DATABASE_URL=postgresql://localhost/karaoke python bench/query_plans.py [--keep]
+'''
+import json
+import os
+import sys
+import psycopg2
+from dataset import HISTORY, PASSWORD, PENDING, migrate, seed
+from handlers import load_handler
+
+SCHEMA = 'plan_check'
+LARGE_RELATIONS = ('queue', 'songs', 'song_lyrics')
+# Сводка админки считает статистику по всей библиотеке, полный проход по songs здесь ожидаем
+SEQ_SCAN_ALLOWED = {'admin dashboard': ('songs',)}
+# Что попадает в отчёт: запросы к данным; PREPARE, SET, LISTEN и т.п. — нет
+EXPLAINED = ('SELECT', 'WITH', 'EXECUTE', 'INSERT', 'UPDATE', 'DELETE')
+
+def plan_nodes(node: dict):
+    '''Все узлы плана EXPLAIN (FORMAT JSON) в глубину'''
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+def record_statements(modules: list) -> list:
+    '''Примешивает к курсору функций запись выполненных (соединение, запрос, параметры)'''
+    statements = []
+    
+    class RecordingCursor:
+        def execute(self, query, vars=None):
+            if isinstance(query, str) and query.lstrip().upper().startswith(EXPLAINED):
+                statements.append((self.connection, query, vars))
+            return super().execute(query, vars)
+    
+    for module in modules:
+        module.TracedCursor = type('RecordingCursor', (RecordingCursor, module.TracedCursor), {})
+    return statements
+
+def split_statements(query: str, params) -> list:
+    '''Операторы запроса по отдельности: EXPLAIN принимает один. Позиционные параметры делятся по %s'''
+    parts = [part for part in query.split(';') if part.strip()]
+    if params is None or isinstance(params, dict):
+        return [(part, params) for part in parts]
+    result = []
+    offset = 0
+    for part in parts:
+        count = part.count('%s')
+        result.append((part, tuple(params[offset:offset + count])))
+        offset += count
+    return result
+
+def explain(conn, query: str, params) -> dict:
+    '''EXPLAIN ANALYZE на соединении обработчика (там подготовлены его операторы); изменения откатываются'''
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, params)
+            return cursor.fetchone()[0][0]
+    finally:
+        conn.rollback()
+
+def main(keep: bool) -> int:
+    '''Код выхода 1, если хотя бы один случай регрессировал'''
+    os.environ['MAIN_DB_SCHEMA'] = SCHEMA
+    os.environ.setdefault('SESSION_SECRET', 'plan-check')
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'plan-check')
+    
+    auth = load_handler('auth')
+    queue = load_handler('queue')
+    songs = load_handler('songs')
+    tables = load_handler('tables')
+    sweeper = load_handler('sweeper')
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cursor = conn.cursor()
+    migrate(cursor, SCHEMA)
+    seed(cursor, tables.hash_password(PASSWORD))
+    conn.commit()
+    conn.autocommit = True
+    
+    admin_session = {'X-Session-Token': auth.issue_session('admin', 1)['token']}
+    table_session = {'X-Session-Token': auth.issue_session('table', 7)['token'], 'Idempotency-Key': 'plan-check'}
+    # Свои треки для каждой пачки: после вызова они уже не ожидают
+    cursor.execute("SELECT id FROM queue WHERE status = 'pending' ORDER BY id DESC LIMIT 6")
+    pending = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT id FROM queue WHERE status = 'playing'")
+    playing_id = cursor.fetchone()[0]
+    
+    def get(module, params: dict, headers: dict = None):
+        def call():
+            songs._catalog_cache.update(version=None, checked_at=0.0, pages={})
+            return module.handler({'httpMethod': 'GET', 'queryStringParameters': params, 'headers': headers}, None)
+        return call
+    
+    def send(module, method: str, body: dict, headers: dict):
+        return lambda: module.handler({'httpMethod': method, 'body': json.dumps(body), 'headers': headers}, None)
+    
+    def login(action: str, username: str):
+        body = json.dumps({'action': action, 'username': username, 'password': PASSWORD})
+        return lambda: auth.handler({'httpMethod': 'POST', 'body': body}, None)
+    
+    # (случай, вызов, индексы, которые должны быть в плане, бюджет по времени выполнения в мс)
+    cases = [
+        ('queue pending', get(queue, {'status': 'pending'}), {'idx_queue_pending_play_order', 'idx_queue_playing'}, 50),
+        ('queue table history', get(queue, {'table_id': '7', 'status': 'played'}), {'idx_queue_table_status_added'}, 50),
+        ('queue changes', get(queue, {'since': str(HISTORY + PENDING - 20)}), {'idx_queue_revision'}, 10),
+        ('admin dashboard', get(queue, {'view': 'dashboard'}, admin_session), {'idx_queue_pending_play_order'}, 150),
+        ('songs page', get(songs, {'limit': '100'}), {'idx_songs_artist_title_id'}, 10),
+        ('songs genre page', get(songs, {'genre': 'Рок', 'limit': '100'}), {'idx_songs_genre_artist_title_id'}, 10),
+        ('songs search', get(songs, {'search': 'ispolnitel 42'}), {'idx_songs_search_trgm'}, 100),
+        ('songs lyrics', get(songs, {'lyrics': 'группа крови'}), {'idx_song_lyrics_search'}, 100),
+        ('tables list', get(tables, {}, admin_session), set(), 10),
+        ('admin login', login('admin_login', 'Ixen4300'), set(), 5),
+        ('table login', login('table_login', 'table7'), set(), 5),
+        ('queue enqueue', send(queue, 'POST', {'song_id': 42, 'table_id': 7}, table_session), set(), 20),
+        ('queue cancel', send(queue, 'PUT', {'action': 'cancel', 'ids': pending[:2]}, admin_session), set(), 20),
+        ('queue reorder', send(queue, 'PUT', {'action': 'reorder', 'ids': pending[2:4]}, admin_session), set(), 20),
+        ('queue move', send(queue, 'PUT', {'action': 'move', 'ids': pending[4:6], 'table_id': 9}, admin_session), set(), 20),
+        ('queue advance', send(queue, 'PUT', {'action': 'advance', 'current_id': playing_id}, admin_session), {'idx_queue_playing'}, 20),
+        ('sweeper', send(sweeper, 'POST', {}, admin_session), {'idx_queue_finished'}, 50)
+    ]
+    
+    statements = record_statements([auth, queue, songs, tables, sweeper])
+    failures = []
+    print(f"{'case':<22}{'statements':>11}{'exec ms':>10}{'budget':>8}")
+    for label, call, indexes, budget in cases:
+        statements.clear()
+        call()
+        used = set()
+        elapsed = 0.0
+        explained = [(c, sql, params) for c, query, vars in statements for sql, params in split_statements(query, vars)]
+        for statement_conn, sql, params in explained:
+            result = explain(statement_conn, sql, params)
+            elapsed += result['Execution Time']
+            for node in plan_nodes(result['Plan']):
+                if 'Index Name' in node:
+                    used.add(node['Index Name'])
+                relation = node.get('Relation Name')
+                if node['Node Type'] == 'Seq Scan' and relation in LARGE_RELATIONS and relation not in SEQ_SCAN_ALLOWED.get(label, ()):
+                    failures.append(f'{label}: Seq Scan on {relation}')
+        for index in indexes - used:
+            failures.append(f'{label}: plan does not use {index}')
+        if elapsed > budget:
+            failures.append(f'{label}: {elapsed:.1f} ms over budget {budget} ms')
+        print(f'{label:<22}{len(statements):>11}{elapsed:>10.2f}{budget:>8}')
+    
+    if not keep:
+        cursor.execute(f'DROP SCHEMA {SCHEMA} CASCADE')
+    conn.close()
+    
+    for failure in failures:
+        print('FAIL', failure)
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main('--keep' in sys.argv))
@@ -0,0 +1,76 @@
+'''Бенчмарк сериализации и сжатия ответа каталога на 50 000 треков.
+
+Строки строятся в памяти так же, как их отдаёт курсор (кортежи с datetime),
+без БД. Сравнивает прежний путь (dict и isoformat на каждую строку, json.dumps),
+текущий encode_json функции songs со стандартным json и с orjson, затем
+размер и время тела ответа без сжатия, в gzip и в brotli.
+
+    SESSION_SECRET=bench AWS_ACCESS_KEY_ID=bench python bench/serialization.py 5
+'''
+import json
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from dataset import SONGS
+from handlers import load_handler
+
+def catalog_rows() -> list:
+    '''Строки songs как из курсора, распределение значений как в dataset.seed'''
+    created = datetime(2024, 1, 1, 12, 0, 0, 250000)
+    genres = ('Поп', 'Рок', 'Шансон', 'Эстрада', 'Без жанра')
+    return [
+        (g, f'Песня {g}', f'Исполнитель {g % 5000}', genres[g % 5], f'https://cdn.example/{g}.kar', 'kar', 120 + g % 240, created + timedelta(seconds=g))
+        for g in range(1, SONGS + 1)
+    ]
+
+def legacy_encode(rows: list, fields: tuple) -> bytes:
+    '''Прежний путь обработчика: dict на строку, isoformat в цикле, json.dumps с экранированием кириллицы'''
+    result = []
+    for song in rows:
+        row = dict(zip(fields, song))
+        if row.get('created_at'):
+            row['created_at'] = row['created_at'].isoformat()
+        result.append({f: row[f] for f in fields})
+    return json.dumps({'songs': result, 'next_cursor': None}).encode('utf-8')
+
+def measure(call, iterations: int):
+    '''Результат последнего вызова и медиана времени в мс'''
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        result = call()
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings)
+
+def main(iterations: int) -> None:
+    songs = load_handler('songs')
+    fields = songs.SONG_FIELDS
+    rows = catalog_rows()
+    fast_encoder = songs.orjson
+    
+    def current(encoder):
+        def call():
+            songs.orjson = encoder
+            return songs.encode_json({'songs': [dict(zip(fields, song)) for song in rows], 'next_cursor': None})
+        return call
+    
+    encoders = {'legacy': lambda: legacy_encode(rows, fields), 'json': current(None)}
+    if fast_encoder is not None:
+        encoders['orjson'] = current(fast_encoder)
+    
+    print(f'{SONGS} rows')
+    print(f"{'encoder':<10}{'ms':>10}{'bytes':>12}")
+    body = None
+    for label, call in encoders.items():
+        body, elapsed = measure(call, iterations)
+        print(f'{label:<10}{elapsed:>10.1f}{len(body):>12}')
+    
+    encodings = [None, 'gzip'] + (['br'] if songs.brotli is not None else [])
+    print(f"{'encoding':<10}{'ms':>10}{'bytes':>12}")
+    for encoding in encodings:
+        encoded, elapsed = measure(lambda: songs.encoded_body(body, encoding), iterations)
+        print(f"{encoding or 'identity':<10}{elapsed:>10.1f}{len(encoded):>12}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,21 @@
+-- Триграммный поиск по трекам с транслитерацией (кириллица -> латиница).
+-- Расширение в public: функции обращаются к word_similarity и <% без схемы,
+-- а search_path их соединений схему приложения не содержит
+CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public;
+
+-- Приведение строки к нижнему регистру латиницей, чтобы "Кино" находилось по "kino" и наоборот
+CREATE OR REPLACE FUNCTION karaoke_translit(src TEXT) RETURNS TEXT AS $$
+    SELECT translate(
+        replace(replace(replace(replace(replace(replace(replace(replace(lower(src),
+            'щ', 'shch'), 'ж', 'zh'), 'х', 'kh'), 'ц', 'ts'), 'ч', 'ch'), 'ш', 'sh'), 'ю', 'yu'), 'я', 'ya'),
+        'абвгдеёзийклмнопрстуфыэъь',
+        'abvgdeeziiklmnoprstufye'
+    )
+$$ LANGUAGE SQL IMMUTABLE PARALLEL SAFE;
+
+-- Нормализованная строка "исполнитель название", пересчитывается автоматически
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_text TEXT
+    GENERATED ALWAYS AS (karaoke_translit(artist || ' ' || title)) STORED;
+
+-- GIN-индекс покрывает и LIKE '%...%', и нечеткое сравнение (<%) с опечатками
+CREATE INDEX IF NOT EXISTS idx_songs_search_trgm ON songs USING GIN (search_text public.gin_trgm_ops);
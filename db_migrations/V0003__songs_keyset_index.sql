@@ -0,0 +1,2 @@
+-- Индекс для постраничной выборки библиотеки по ключу (artist, title, id)
+CREATE INDEX IF NOT EXISTS idx_songs_artist_title_id ON songs(artist, title, id);
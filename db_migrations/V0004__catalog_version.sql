@@ -0,0 +1,9 @@
+-- Версия каталога треков: увеличивается при каждом изменении библиотеки
+CREATE TABLE IF NOT EXISTS catalog_version (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO catalog_version (id, version) VALUES (1, 1)
+ON CONFLICT (id) DO NOTHING;
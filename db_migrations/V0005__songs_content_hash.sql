@@ -0,0 +1,4 @@
+-- Хранение файлов по SHA-256 содержимого и защита от дубликатов
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS content_hash CHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_songs_content_hash ON songs(content_hash) WHERE content_hash IS NOT NULL;
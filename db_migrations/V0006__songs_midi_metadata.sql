@@ -0,0 +1,11 @@
+-- Метаданные, извлечённые из .kar/.mid при загрузке
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS tempo_bpm NUMERIC(6, 2);
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS track_count SMALLINT;
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS channel_count SMALLINT;
+
+-- Текст песни: целиком и построчно с временем начала строки (секунды)
+CREATE TABLE IF NOT EXISTS song_lyrics (
+    song_id INTEGER PRIMARY KEY REFERENCES songs(id) ON DELETE CASCADE,
+    lyrics TEXT NOT NULL,
+    lines JSONB NOT NULL DEFAULT '[]'
+);
@@ -0,0 +1,8 @@
+-- Полнотекстовый индекс по текстам песен для поиска по строчке
+ALTER TABLE song_lyrics ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('simple', lyrics)) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_song_lyrics_search ON song_lyrics USING GIN (search_vector);
+
+-- Треки, файлы которых ещё не разбирались (для фоновой дообработки)
+CREATE INDEX IF NOT EXISTS idx_songs_unparsed ON songs(id) WHERE track_count IS NULL;
@@ -0,0 +1,19 @@
+-- Ревизия очереди: растёт при каждом изменении строки, по ней клиенты забирают только изменения
+CREATE SEQUENCE IF NOT EXISTS queue_revision_seq;
+
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS revision BIGINT NOT NULL DEFAULT nextval('queue_revision_seq');
+
+CREATE INDEX IF NOT EXISTS idx_queue_revision ON queue(revision);
+
+-- Новая ревизия и NOTIFY для ожидающих клиентов (пустой payload схлопывается в один NOTIFY на транзакцию)
+CREATE OR REPLACE FUNCTION queue_touch_revision() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.revision := nextval('queue_revision_seq');
+    PERFORM pg_notify('queue_changes', '');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+DROP TRIGGER IF EXISTS queue_touch_revision ON queue;
+CREATE TRIGGER queue_touch_revision BEFORE INSERT OR UPDATE ON queue
+    FOR EACH ROW EXECUTE FUNCTION queue_touch_revision();
@@ -0,0 +1,13 @@
+-- Раунд справедливой очереди: треки столов чередуются по кругу, порядок считается один раз при добавлении
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS sched_round DOUBLE PRECISION NOT NULL DEFAULT 0;
+
+UPDATE queue q SET sched_round = r.rn
+FROM (
+    SELECT id, ROW_NUMBER() OVER (PARTITION BY table_id ORDER BY added_at, id) AS rn
+    FROM queue
+    WHERE status IN ('pending', 'playing')
+) r
+WHERE q.id = r.id;
+
+CREATE INDEX IF NOT EXISTS idx_queue_pending_schedule ON queue(sched_round, added_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_queue_table_active_round ON queue(table_id, sched_round) WHERE status IN ('pending', 'playing');
@@ -0,0 +1,20 @@
+-- Внешние ключи очереди. NOT VALID: проверяются новые строки, старые записи не блокируют миграцию
+ALTER TABLE queue ADD CONSTRAINT queue_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs(id) NOT VALID;
+ALTER TABLE queue ADD CONSTRAINT queue_table_id_fkey FOREIGN KEY (table_id) REFERENCES tables(id) NOT VALID;
+
+-- Индекс под внешний ключ и соединение queue -> songs
+CREATE INDEX IF NOT EXISTS idx_queue_song_id ON queue(song_id);
+
+-- Выборка очереди по статусу в порядке добавления; заменяет одноколоночный idx_queue_status
+CREATE INDEX IF NOT EXISTS idx_queue_status_added ON queue(status, added_at, id);
+DROP INDEX IF EXISTS idx_queue_status;
+
+-- Очередь одного стола (в любом статусе) и внешний ключ queue -> tables
+CREATE INDEX IF NOT EXISTS idx_queue_table_status_added ON queue(table_id, status, added_at, id);
+
+-- Горячее множество: ожидающие треки в порядке FIFO и текущий играющий трек
+CREATE INDEX IF NOT EXISTS idx_queue_pending_added ON queue(added_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_queue_playing ON queue(played_at DESC) WHERE status = 'playing';
+
+-- Постраничная выборка библиотеки внутри жанра
+CREATE INDEX IF NOT EXISTS idx_songs_genre_artist_title_id ON songs(genre, artist, title, id);
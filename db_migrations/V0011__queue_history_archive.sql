@@ -0,0 +1,47 @@
+-- Время завершения трека (сыгран или снят): от него отсчитывается перенос в архив
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP;
+
+-- Заполнение истории без триггера: иначе каждая старая строка получает новую ревизию и NOTIFY,
+-- и все планшеты перечитывают всю историю из ленты изменений
+ALTER TABLE queue DISABLE TRIGGER queue_touch_revision;
+UPDATE queue SET finished_at = COALESCE(played_at, added_at)
+WHERE status IN ('played', 'cancelled') AND finished_at IS NULL;
+ALTER TABLE queue ENABLE TRIGGER queue_touch_revision;
+
+CREATE INDEX IF NOT EXISTS idx_queue_finished ON queue(finished_at) WHERE status IN ('played', 'cancelled');
+
+-- Ревизия, NOTIFY и отметка завершения в одном триггере
+CREATE OR REPLACE FUNCTION queue_touch_revision() RETURNS TRIGGER AS $$
+BEGIN
+    NEW.revision := nextval('queue_revision_seq');
+    IF NEW.status IN ('played', 'cancelled') THEN
+        NEW.finished_at := COALESCE(NEW.finished_at, LOCALTIMESTAMP);
+    ELSE
+        NEW.finished_at := NULL;
+    END IF;
+    PERFORM pg_notify('queue_changes', '');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+-- Архив завершённых треков: живая очередь остаётся маленькой, история доступна для отчётов
+CREATE TABLE IF NOT EXISTS queue_history (
+    id INTEGER PRIMARY KEY,
+    song_id INTEGER NOT NULL,
+    table_id INTEGER NOT NULL,
+    status VARCHAR(50) NOT NULL,
+    added_at TIMESTAMP,
+    played_at TIMESTAMP,
+    finished_at TIMESTAMP,
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_queue_history_added ON queue_history(added_at);
+CREATE INDEX IF NOT EXISTS idx_queue_history_table_added ON queue_history(table_id, added_at);
+CREATE INDEX IF NOT EXISTS idx_queue_history_song ON queue_history(song_id);
+
+-- Вся история заказов (живая очередь + архив) для отчётов
+CREATE OR REPLACE VIEW queue_report AS
+SELECT id, song_id, table_id, status, added_at, played_at, finished_at FROM queue
+UNION ALL
+SELECT id, song_id, table_id, status, added_at, played_at, finished_at FROM queue_history;
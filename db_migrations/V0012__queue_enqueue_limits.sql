@@ -0,0 +1,9 @@
+-- Ведро токенов стола для добавления треков: остаток и время последнего пополнения.
+-- NULL — ведро полное (стол ещё ничего не добавлял)
+ALTER TABLE tables ADD COLUMN IF NOT EXISTS enqueue_tokens DOUBLE PRECISION;
+ALTER TABLE tables ADD COLUMN IF NOT EXISTS enqueue_refilled_at TIMESTAMP;
+
+-- Ключ идемпотентности добавления: повтор запроса планшета с тем же ключом не создаёт второй трек
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_queue_table_idempotency_key ON queue(table_id, idempotency_key) WHERE idempotency_key IS NOT NULL;
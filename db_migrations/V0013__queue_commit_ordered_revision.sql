@@ -0,0 +1,31 @@
+-- Ревизия выдаётся при коммите, а не при записи строки. Иначе транзакция, взявшая ревизию раньше,
+-- но закоммитившая позже соседней, оказывается ниже since у клиента и её изменение теряется
+
+-- Отметка завершения и NOTIFY остаются при записи строки
+CREATE OR REPLACE FUNCTION queue_touch_revision() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.status IN ('played', 'cancelled') THEN
+        NEW.finished_at := COALESCE(NEW.finished_at, LOCALTIMESTAMP);
+    ELSE
+        NEW.finished_at := NULL;
+    END IF;
+    PERFORM pg_notify('queue_changes', '');
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+-- Отложенный до коммита триггер: advisory-lock держится до конца коммита, поэтому ревизии
+-- выдаются в порядке коммитов, и видимая клиенту ревизия r означает, что все ревизии ниже r уже видны
+CREATE OR REPLACE FUNCTION queue_commit_revision() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('queue_revision'));
+    UPDATE queue SET revision = nextval('queue_revision_seq') WHERE id = NEW.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql SET search_path FROM CURRENT;
+
+-- WHEN отсекает UPDATE из самого триггера, иначе он ставил бы себя в очередь снова
+DROP TRIGGER IF EXISTS queue_commit_revision ON queue;
+CREATE CONSTRAINT TRIGGER queue_commit_revision AFTER INSERT OR UPDATE ON queue
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW WHEN (pg_trigger_depth() < 1) EXECUTE FUNCTION queue_commit_revision();
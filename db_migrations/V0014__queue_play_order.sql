@@ -0,0 +1,24 @@
+-- Место трека в очереди отдельно от времени добавления: перестановка администратором меняет
+-- только раунд и место, а added_at остаётся временем заказа для ETA, архива и отчётов
+CREATE SEQUENCE IF NOT EXISTS queue_play_order_seq;
+ALTER TABLE queue ADD COLUMN IF NOT EXISTS play_order BIGINT;
+
+-- Заполнение без триггеров: место не меняет видимых клиентам полей, ревизии и NOTIFY не нужны
+ALTER TABLE queue DISABLE TRIGGER queue_touch_revision;
+ALTER TABLE queue DISABLE TRIGGER queue_commit_revision;
+UPDATE queue q SET play_order = o.n
+FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY added_at, id) AS n FROM queue) o
+WHERE q.id = o.id AND q.play_order IS NULL;
+ALTER TABLE queue ENABLE TRIGGER queue_commit_revision;
+ALTER TABLE queue ENABLE TRIGGER queue_touch_revision;
+
+SELECT setval('queue_play_order_seq', COALESCE((SELECT MAX(play_order) FROM queue), 0) + 1, false);
+ALTER SEQUENCE queue_play_order_seq OWNED BY queue.play_order;
+ALTER TABLE queue ALTER COLUMN play_order SET DEFAULT nextval('queue_play_order_seq');
+ALTER TABLE queue ALTER COLUMN play_order SET NOT NULL;
+
+-- Порядок ожидающих треков теперь по месту, а не по времени добавления
+CREATE INDEX IF NOT EXISTS idx_queue_pending_play_order ON queue(play_order) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_queue_pending_round_order ON queue(sched_round, play_order) WHERE status = 'pending';
+DROP INDEX IF EXISTS idx_queue_pending_added;
+DROP INDEX IF EXISTS idx_queue_pending_schedule;
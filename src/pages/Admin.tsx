@@ -16,6 +16,11 @@ const TABLES_URL = 'https://functions.poehali.dev/96982b55-0efb-4c87-bf99-5eec30
 const SONGS_URL = 'https://functions.poehali.dev/f15e4069-7dc9-4270-bd8e-60dd77f495ae';
 const QUEUE_URL = 'https://functions.poehali.dev/1069be66-7cfa-40f0-8348-8d108c743c84';
 
+const authHeaders = () => ({
+  'Content-Type': 'application/json',
+  'X-Session-Token': localStorage.getItem('session') || '',
+});
+
 interface Table {
   id: number;
   table_number: number;
@@ -48,7 +53,10 @@ const Admin = () => {
   const navigate = useNavigate();
   const [tables, setTables] = useState<Table[]>([]);
   const [songs, setSongs] = useState<Song[]>([]);
+  const [songsCursor, setSongsCursor] = useState<string | null>(null);
   const [queue, setQueue] = useState<QueueItem[]>([]);
+  const [playingId, setPlayingId] = useState<number | null>(null);
+  const [catalogTotal, setCatalogTotal] = useState<number | null>(null);
   const [loading, setLoading] = useState(false);
   const [newTable, setNewTable] = useState({ table_number: '', login: '', password: '', hours: '2' });
   const [editTable, setEditTable] = useState<Table | null>(null);
@@ -63,41 +71,40 @@ const Admin = () => {
       navigate('/login');
       return;
     }
-    fetchTables();
+    fetchDashboard();
     fetchSongs();
-    fetchQueue();
   }, [navigate]);
 
-  const fetchTables = async () => {
+  const fetchDashboard = async () => {
     try {
-      const response = await fetch(TABLES_URL);
+      const response = await fetch(`${QUEUE_URL}?view=dashboard`, { headers: authHeaders() });
       const data = await response.json();
+      if (!response.ok) {
+        toast.error(data.error || 'Ошибка загрузки данных');
+        return;
+      }
       setTables(data.tables || []);
+      setQueue(data.queue || []);
+      setPlayingId(data.playing_id ?? null);
+      setCatalogTotal(data.catalog?.songs ?? null);
     } catch (error) {
-      toast.error('Ошибка загрузки столов');
+      toast.error('Ошибка загрузки данных');
     }
   };
 
-  const fetchSongs = async () => {
+  const fetchSongs = async (cursor: string | null = null) => {
     try {
-      const response = await fetch(SONGS_URL);
+      const params = new URLSearchParams({ fields: 'id,title,artist,genre,file_format', limit: '100' });
+      if (cursor) params.set('cursor', cursor);
+      const response = await fetch(`${SONGS_URL}?${params}`);
       const data = await response.json();
-      setSongs(data.songs || []);
+      setSongs((prev) => (cursor ? [...prev, ...(data.songs || [])] : data.songs || []));
+      setSongsCursor(data.next_cursor || null);
     } catch (error) {
       toast.error('Ошибка загрузки треков');
     }
   };
 
-  const fetchQueue = async () => {
-    try {
-      const response = await fetch(`${QUEUE_URL}?status=pending`);
-      const data = await response.json();
-      setQueue(data.queue || []);
-    } catch (error) {
-      toast.error('Ошибка загрузки очереди');
-    }
-  };
-
   const handleCreateTable = async (e: React.FormEvent) => {
     e.preventDefault();
     setLoading(true);
@@ -105,7 +112,7 @@ const Admin = () => {
     try {
       const response = await fetch(TABLES_URL, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify({
           table_number: parseInt(newTable.table_number),
           login: newTable.login,
@@ -119,7 +126,7 @@ const Admin = () => {
       if (response.ok && data.success) {
         toast.success('Стол создан успешно');
         setNewTable({ table_number: '', login: '', password: '', hours: '2' });
-        fetchTables();
+        fetchDashboard();
       } else {
         toast.error(data.error || 'Ошибка создания стола');
       }
@@ -144,7 +151,7 @@ const Admin = () => {
 
       const response = await fetch(TABLES_URL, {
         method: 'PUT',
-        headers: { 'Content-Type': 'application/json' },
+        headers: authHeaders(),
         body: JSON.stringify(body),
       });
 
@@ -154,7 +161,7 @@ const Admin = () => {
         toast.success('Стол обновлен успешно');
         setIsEditDialogOpen(false);
         setEditTable(null);
-        fetchTables();
+        fetchDashboard();
       } else {
         toast.error(data.error || 'Ошибка обновления стола');
       }
@@ -169,13 +176,14 @@ const Admin = () => {
     try {
       const response = await fetch(`${TABLES_URL}?id=${tableId}`, {
         method: 'DELETE',
+        headers: authHeaders(),
       });
 
       const data = await response.json();
 
       if (response.ok && data.success) {
         toast.success('Стол удален');
-        fetchTables();
+        fetchDashboard();
       } else {
         toast.error(data.error || 'Ошибка удаления стола');
       }
@@ -199,14 +207,20 @@ const Admin = () => {
     setSelectedTableForKaraoke(tableNumber);
     
     try {
-      await fetch(QUEUE_URL, {
+      const response = await fetch(QUEUE_URL, {
         method: 'PUT',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ id: queueId, status: 'playing' }),
+        headers: authHeaders(),
+        body: JSON.stringify({ action: 'advance', current_id: playingId, next_id: queueId }),
       });
+      const data = await response.json();
       
-      toast.success(`Караоке выведено на экран стола ${tableNumber}`);
-      fetchQueue();
+      if (response.ok) {
+        setPlayingId(data.playing?.id ?? null);
+        toast.success(`Караоке выведено на экран стола ${tableNumber}`);
+      } else {
+        toast.error(data.error || 'Ошибка воспроизведения');
+      }
+      fetchDashboard();
     } catch (error) {
       toast.error('Ошибка воспроизведения');
     }
@@ -222,38 +236,60 @@ const Admin = () => {
     setLoading(true);
 
     try {
-      const reader = new FileReader();
-      reader.onload = async () => {
-        const base64 = (reader.result as string).split(',')[1];
-        const fileFormat = newSong.file!.name.split('.').pop() || 'kar';
-
-        const response = await fetch(SONGS_URL, {
-          method: 'POST',
-          headers: { 'Content-Type': 'application/json' },
-          body: JSON.stringify({
-            title: newSong.title,
-            artist: newSong.artist,
-            genre: newSong.genre || 'Без жанра',
-            file_data: base64,
-            file_format: fileFormat,
-          }),
-        });
-
-        const data = await response.json();
-
-        if (response.ok && data.success) {
-          toast.success('Трек добавлен в библиотеку');
-          setNewSong({ title: '', artist: '', genre: '', file: null });
-          fetchSongs();
-        } else {
-          toast.error(data.error || 'Ошибка загрузки трека');
-        }
-        setLoading(false);
-      };
-
-      reader.readAsDataURL(newSong.file);
+      const fileFormat = newSong.file.name.split('.').pop()?.toLowerCase() || 'kar';
+      const digest = await crypto.subtle.digest('SHA-256', await newSong.file.arrayBuffer());
+      const contentHash = Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+
+      const urlResponse = await fetch(SONGS_URL, {
+        method: 'POST',
+        headers: authHeaders(),
+        body: JSON.stringify({ action: 'upload_url', file_format: fileFormat, content_hash: contentHash }),
+      });
+      const upload = await urlResponse.json();
+      if (!urlResponse.ok || !upload.success) {
+        toast.error(upload.error || 'Ошибка загрузки трека');
+        return;
+      }
+      if (upload.duplicate) {
+        toast.info(`Трек уже есть в библиотеке: ${upload.song.artist} — ${upload.song.title}`);
+        return;
+      }
+
+      const putResponse = await fetch(upload.upload_url, {
+        method: 'PUT',
+        headers: upload.upload_headers,
+        body: newSong.file,
+      });
+      if (!putResponse.ok) {
+        toast.error('Ошибка загрузки файла');
+        return;
+      }
+
+      const response = await fetch(SONGS_URL, {
+        method: 'POST',
+        headers: authHeaders(),
+        body: JSON.stringify({
+          action: 'finalize',
+          title: newSong.title,
+          artist: newSong.artist,
+          genre: newSong.genre || 'Без жанра',
+          file_format: fileFormat,
+          file_key: upload.file_key,
+        }),
+      });
+
+      const data = await response.json();
+
+      if (response.ok && data.success) {
+        toast.success('Трек добавлен в библиотеку');
+        setNewSong({ title: '', artist: '', genre: '', file: null });
+        fetchSongs();
+      } else {
+        toast.error(data.error || 'Ошибка загрузки трека');
+      }
     } catch (error) {
       toast.error('Ошибка загрузки файла');
+    } finally {
       setLoading(false);
     }
   };
@@ -451,7 +487,7 @@ const Admin = () => {
               <div className="flex items-center gap-2 mb-4">
                 <Icon name="Music" size={24} className="text-primary" />
                 <h2 className="text-xl font-semibold">Библиотека треков</h2>
-                <Badge variant="outline" className="ml-auto">{songs.length}</Badge>
+                <Badge variant="outline" className="ml-auto">{catalogTotal ?? songs.length}</Badge>
               </div>
 
               <Dialog>
@@ -523,6 +559,11 @@ const Admin = () => {
                   </div>
                 ))}
               </div>
+              {songsCursor && (
+                <Button variant="outline" className="w-full mt-4" onClick={() => fetchSongs(songsCursor)}>
+                  Загрузить ещё
+                </Button>
+              )}
             </Card>
           </TabsContent>
         </Tabs>
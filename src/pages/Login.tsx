@@ -35,6 +35,7 @@ const Login = () => {
 
       if (response.ok && data.success) {
         localStorage.setItem('user', JSON.stringify(data.user));
+        localStorage.setItem('session', data.session.token);
         localStorage.setItem('role', 'admin');
         toast.success('Добро пожаловать, администратор!');
         navigate('/admin');
@@ -67,6 +68,7 @@ const Login = () => {
 
       if (response.ok && data.success) {
         localStorage.setItem('table', JSON.stringify(data.table));
+        localStorage.setItem('session', data.session.token);
         localStorage.setItem('role', 'table');
         toast.success(`Добро пожаловать, стол ${data.table.table_number}!`);
         navigate('/table');